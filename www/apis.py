@@ -7,7 +7,7 @@ __author__ = 'Yihang Ding'
 JSON API definition.
 '''
 
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 
 class APIError(Exception):
 	"""
@@ -62,9 +62,46 @@ class Page(object):
 
 	__repr__ = __str__
 
+def encode_cursor(created_at, pk):
+	' make an opaque cursor from the (created_at, id) of the last item on a page. '
+	s = json.dumps([created_at, pk], separators = (',', ':'))
+	return base64.urlsafe_b64encode(s.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+	' return (created_at, id) or None for the first page. '
+	if not cursor:
+		return None
+	try:
+		s = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+		created_at, pk = json.loads(s)
+		return (float(created_at), str(pk))
+	except (ValueError, TypeError):
+		raise APIValueError('cursor', 'Invalid cursor.')
+
+class CursorPage(object):
+	'''
+	keyset pagination: the page is located by the cursor of the last item
+	on the previous page instead of an offset, so no rows are skipped
+	and no count is needed. One extra row is fetched to know if there is a next page.
+	'''
+	def __init__(self, cursor = '', page_size = 10):
+		self.cursor = cursor or ''
+		self.page_size = page_size
+		self.seek = decode_cursor(cursor)
+		self.limit = page_size + 1
+		self.next_cursor = ''
+		self.has_next = False
+		self.has_previous = self.seek is not None
+
+	def paginate(self, items):
+		if len(items) > self.page_size:
+			items = items[:self.page_size]
+			self.has_next = True
+			last = items[-1]
+			self.next_cursor = encode_cursor(last.created_at, last.id)
+		return items
 
+	def __str__(self):
+		return 'cursor: %s, page_size: %s, next_cursor: %s' % (self.cursor, self.page_size, self.next_cursor)
 
-
-
-
-
+	__repr__ = __str__
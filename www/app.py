@@ -12,11 +12,11 @@ import asyncio, os, json, time
 from datetime import datetime
 from aiohttp import web
 
-import orm
+import orm, cache, render
 from jinja2 import Environment,FileSystemLoader
 from coroweb import add_routes, add_static
 from config  import configs
-from handlers import cookie2user, COOKIE_NAME
+from handlers import cookie2user, subscribe_session_invalidations, COOKIE_NAME
 
 def init_jinja2(app, **kw):  #initiate jinja2
 	logging.info('init jinja2...')
@@ -52,6 +52,18 @@ async def logger_factory(app, handler):
 	return logger
 
 
+# middleware: give every request its own identity map so that
+# the same row is never fetched twice by Model.find() within a request,
+# and reset the read-your-writes stickiness of the replica routing.
+async def orm_factory(app, handler):
+	async def identity(request):
+		tokens = orm.begin_request()
+		try:
+			return (await handler(request))
+		finally:
+			orm.end_request(tokens)
+	return identity
+
 # middleware #2: authentication
 async def auth_factory(app, handler):
 	async def auth(request):
@@ -61,7 +73,7 @@ async def auth_factory(app, handler):
 		if cookie_str:
 			user = await cookie2user(cookie_str)
 			if user:
-				logging.info('set current user: %s' % user.email)
+				logging.info('set current user: %s' % user.name)
 				request.__user__ = user
 		if request.path.startswith('/manage/') and (request.__user__ is None or not request.__user__.admin):
 			return web.HTTPFound('/signin')
@@ -81,6 +93,11 @@ async def data_factory(app, handler):
 		return (await handler(request))
 	return parse_data
 
+def json_default(o):
+	if isinstance(o, orm.Row):
+		return o.asdict()
+	return o.__dict__
+
 # middleware #4: deal with output after handler
 async def response_factory(app, handler):
 	async def response(request):
@@ -103,7 +120,7 @@ async def response_factory(app, handler):
 		if isinstance(r, dict):
 			template = r.get('__template__')
 			if template is None:
-				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+				resp = web.Response(body=json.dumps(r, ensure_ascii=False, default=json_default).encode('utf-8'))
 				resp.content_type = 'application/json;charset=utf-8'
 				return resp
 			else:
@@ -140,8 +157,16 @@ def datetime_filter(t):
 
 #please make sure that the port is 9000
 async def init(loop):
-	await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='root', password='password', db='awesome')
-	app = web.Application(loop=loop,middlewares=[logger_factory,auth_factory,response_factory])
+	# replicas, pool sizes and timeouts come from configs.db
+	db = dict(configs.db, host='127.0.0.1', port=3306, user='root', password='password', db='awesome')
+	await orm.create_pool(loop=loop, **db)
+	orm.configure_count_cache(**configs.count_cache)
+	orm.configure_query_cache(**configs.query_cache)
+	cache.set_cache(cache.create_cache(**configs.cache))
+	await orm.subscribe_invalidations()
+	await subscribe_session_invalidations()
+	render.start_pool(configs.markdown.workers)
+	app = web.Application(loop=loop,middlewares=[logger_factory,orm_factory,auth_factory,response_factory])
 	init_jinja2(app, filters = dict(datetime = datetime_filter))
 	add_routes(app, 'handlers')
 	add_static(app)
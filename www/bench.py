@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yihang Ding'
+
+'''
+micro benchmarks, no database needed.
+
+usage: python3 bench.py [name ...]
+run without names to run all of them.
+'''
+
+import sys, time, tracemalloc
+
+BENCHMARKS = []
+
+def benchmark(fn):
+	BENCHMARKS.append(fn)
+	return fn
+
+def log(s):
+	print('[Bench] %s' % s)
+
+def measure(fn, repeat = 5):
+	' return the best wall time of fn() in seconds. '
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		fn()
+		t = time.perf_counter() - start
+		if best is None or t < best:
+			best = t
+	return best
+
+def memory(fn):
+	' return (result, bytes allocated while calling fn()). '
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		r = fn()
+		after = tracemalloc.get_traced_memory()[0]
+	finally:
+		tracemalloc.stop()
+	return r, after - before
+
+@benchmark
+def rows():
+	' memory and construction time of Blog models vs. Blog rows. '
+	from models import Blog
+	n = 10000
+	names = ['id'] + Blog.__fields__
+	tuples = [('%050d' % i, 'u', 'user', 'http://img', 'name %s' % i, 'summary %s' % i, 'content %s' % i, 1500000000.0 + i) for i in range(n)]
+	# a DictCursor builds one dict per row, then findAll() copies it into a model
+	_, m = memory(lambda: [Blog(**dict(zip(names, r))) for r in tuples])
+	t = measure(lambda: [Blog(**dict(zip(names, r))) for r in tuples])
+	log('Model: %.1f bytes/row, %.2f us/row' % (m / n, t * 1e6 / n))
+	_, m = memory(lambda: Blog.__row__.fromTuples(names, tuples))
+	t = measure(lambda: Blog.__row__.fromTuples(names, tuples))
+	log('Row:   %.1f bytes/row, %.2f us/row' % (m / n, t * 1e6 / n))
+
+@benchmark
+def sql():
+	' python overhead of building the SQL of a findAll() call. '
+	import orm
+	from models import Blog
+	n = 100000
+	def uncached():
+		for i in range(n):
+			sql, deferred = Blog.compileSelect('user_id=?', orderBy='created_at desc', limit=(i, 10))
+			sql.replace('?', '%s')
+			'SQL: %s' % sql
+	def cached():
+		for i in range(n):
+			sql, args, deferred = Blog.buildSelect('user_id=?', ['u'], orderBy='created_at desc', limit=(i, 10))
+			orm.translate(sql)
+			orm.log(sql, args)
+	log('uncached: %.2f us/query' % (measure(uncached) * 1e6 / n))
+	log('cached:   %.2f us/query' % (measure(cached) * 1e6 / n))
+
+@benchmark
+def auth():
+	' cost of cookie2user() per request with and without the session cache. '
+	import asyncio
+	import handlers
+	from models import User
+	user = User(id='001500000000000', passwd='0' * 40, name='test', email='test@example.com', admin=False, image='')
+	async def find(uid):
+		# no database here: the real cost of a cache miss is higher by one round-trip
+		return User(**user)
+	handlers.User.find = find
+	cookie_str = handlers.user2cookie(user, 86400)
+	n = 20000
+	async def run(cached):
+		for i in range(n):
+			if not cached:
+				handlers._sessions.invalidate(cookie_str)
+			await handlers.cookie2user(cookie_str)
+	loop = asyncio.new_event_loop()
+	log('without cache: %.2f us/request' % (measure(lambda: loop.run_until_complete(run(False))) * 1e6 / n))
+	log('with cache:    %.2f us/request' % (measure(lambda: loop.run_until_complete(run(True))) * 1e6 / n))
+	loop.close()
+
+'''
+a corpus of blog posts: the readme plus posts mixing the markdown a blog
+usually has, nested lists, code, tables, links and footnotes.
+'''
+
+_POST = '''## Part %(n)d
+
+Some *text* with a [link](http://example.com/%(n)d "title") and a [reference][r%(n)d],
+`inline code` and **bold** text, see the note[^n%(n)d].
+
+- first item
+- second item
+    - nested item
+    - another nested item
+- third item
+
+1. one
+2. two
+3. three
+
+    def f(x):
+        return x * %(n)d
+
+| a | b |
+|---|---|
+| %(n)d | %(n)d |
+
+> quoted text
+> over two lines
+
+[r%(n)d]: http://example.com/ref/%(n)d
+[^n%(n)d]: The footnote of part %(n)d.
+
+'''
+
+def corpus():
+	import os
+	with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'readme.md'), encoding='utf-8') as f:
+		posts = [f.read()]
+	for parts in (1, 5, 20, 50):
+		posts.append(''.join(_POST % dict(n=n) for n in range(parts)))
+	return posts
+
+@benchmark
+def markdown():
+	' render time per KB of the corpus. '
+	import markdown2
+	posts = corpus()
+	kb = sum(len(p.encode('utf-8')) for p in posts) / 1024.0
+	extras = ['fenced-code-blocks', 'tables', 'footnotes', 'wiki-tables']
+	t = measure(lambda: [markdown2.markdown(p, extras=extras) for p in posts])
+	log('%.1f KB: %.1f us/KB' % (kb, t * 1e6 / kb))
+
+@benchmark
+def setup():
+	' per-call cost of markdown2.markdown() vs. a pooled Markdown on small texts. '
+	import markdown2, render
+	texts = ['A *short* comment, thanks!', 'A summary of the post with a [link](http://example.com/).']
+	pool = render.converter_pool()
+	n = 10000
+	for text in texts:
+		t = measure(lambda: [markdown2.markdown(text) for i in range(n)])
+		log('%d chars, new Markdown: %.1f us/call' % (len(text), t * 1e6 / n))
+		t = measure(lambda: [pool.convert(text) for i in range(n)])
+		log('%d chars, pooled:       %.1f us/call' % (len(text), t * 1e6 / n))
+	t = measure(lambda: [markdown2.Markdown() for i in range(n)])
+	log('Markdown() alone: %.1f us' % (t * 1e6 / n))
+
+@benchmark
+def highlight():
+	' render time of a code-heavy post with and without the highlight cache. '
+	import markdown2
+	code = '```python\ndef f(x):\n    return [i * x for i in range(%d)]\n```\n\n'
+	post = ''.join('Step %d:\n\n' % i + code % i for i in range(30))
+	extras = ['fenced-code-blocks']
+	def render():
+		# a different first line each time, as after an edit
+		render.n += 1
+		markdown2.markdown('Edit %d\n\n' % render.n + post, extras=extras)
+	render.n = 0
+	max_bytes = markdown2.highlight_cache.max_bytes
+	markdown2.highlight_cache.max_bytes = 0
+	log('without cache: %.2f ms/render' % (measure(render) * 1e3))
+	markdown2.highlight_cache.max_bytes = max_bytes
+	log('with cache:    %.2f ms/render' % (measure(render) * 1e3))
+
+@benchmark
+def scaling():
+	' render time per KB from 1KB to 1MB, should stay flat. '
+	import markdown2
+	docs = dict(
+		# one paragraph full of links, _do_links sees all of it at once
+		links = '[a link](http://example.com/ "title") and ![an image](/a.png) ',
+		# one long list
+		lists = '- item with [a link](http://example.com/)\n',
+	)
+	for name, unit in docs.items():
+		for kb in (1, 10, 100, 1000):
+			text = unit * (kb * 1024 // len(unit))
+			t = measure(lambda: markdown2.markdown(text), repeat = 1 if kb >= 100 else 3)
+			log('%s %4d KB: %.1f us/KB' % (name, kb, t * 1e6 / kb))
+
+'''
+inputs known to make markdown2 backtrack or rescan, and random mixes of
+their pieces. fuzz_corpus(seed) always returns the same documents, so a
+slow one is reproduced by its seed and index.
+'''
+
+_PATHOLOGICAL = dict(
+	brackets = '[',
+	links = '[a](',
+	strong = '**a ',
+	em = '*a ',
+	code = '`a ',
+	tags = '<a ',
+	comments = '<!--',
+	autolinks = '<http://',
+	mix = '*[_<`',
+)
+
+def fuzz_corpus(seed = 0, n = 20, size = 12000):
+	import random
+	rnd = random.Random(seed)
+	docs = [(name, unit * (size // len(unit))) for name, unit in sorted(_PATHOLOGICAL.items())]
+	units = list(_PATHOLOGICAL.values()) + ['a', ' ', '\n', '\n\n', ']', ')', '*', '_']
+	for i in range(n):
+		text = []
+		while sum(len(t) for t in text) < size:
+			text.append(rnd.choice(units) * rnd.randint(1, 50))
+		docs.append(('random %d:%d' % (seed, i), ''.join(text)))
+	return docs
+
+@benchmark
+def fuzz():
+	' the slowest documents of the fuzz corpus and where they ran over budget. '
+	import markdown2
+	from config import configs
+	budget = configs.markdown.time_budget
+	results = []
+	for name, text in fuzz_corpus():
+		start = time.perf_counter()
+		html = markdown2.markdown(text, time_budget = budget)
+		results.append((time.perf_counter() - start, name, getattr(html, 'budget_exceeded', None)))
+	results.sort(reverse = True)
+	for t, name, stage in results[:10]:
+		log('%-12s %.3f s%s' % (name, t, ' over budget after %s' % stage if stage else ''))
+	log('%d of %d documents over the %s s budget' % (sum(1 for r in results if r[2]), len(results), budget))
+
+if __name__ == '__main__':
+	selected = sys.argv[1:]
+	for fn in BENCHMARKS:
+		if not selected or fn.__name__ in selected:
+			log('--- %s ---' % fn.__name__)
+			fn()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yihang Ding'
+
+'''
+pluggable cache shared by the orm and the handlers.
+
+MemoryCache keeps everything in this process. RedisCache talks the Redis
+protocol, so that all app.py processes on all hosts share one cache and
+receive each other's invalidation messages over pub/sub.
+
+For local development a tiny stand-in server speaking enough of the
+protocol can be started with: python3 cache.py [port]
+'''
+
+import asyncio, logging, json, time, collections
+
+class CacheError(Exception):
+	pass
+
+class Cache(object):
+	'''
+	the cache interface. Values must be JSON serializable.
+	'''
+	async def get(self, key):
+		raise NotImplementedError
+
+	async def set(self, key, value, ttl = None):
+		raise NotImplementedError
+
+	async def delete(self, key):
+		raise NotImplementedError
+
+	async def incr(self, key, n = 1):
+		raise NotImplementedError
+
+	async def publish(self, channel, message):
+		raise NotImplementedError
+
+	async def subscribe(self, channel, callback):
+		' call callback(message) for every message published on channel. '
+		raise NotImplementedError
+
+	async def close(self):
+		pass
+
+class MemoryCache(Cache):
+
+	def __init__(self, max_entries = 10000, **kw):
+		self.max_entries = max_entries
+		self._data = collections.OrderedDict()  # key => (value, expires)
+		self._subscribers = collections.defaultdict(list)
+
+	def _get(self, key):
+		entry = self._data.get(key)
+		if entry is None:
+			return None
+		if entry[1] is not None and entry[1] < time.time():
+			del self._data[key]
+			return None
+		self._data.move_to_end(key)
+		return entry[0]
+
+	def _set(self, key, value, ttl):
+		self._data[key] = (value, time.time() + ttl if ttl else None)
+		self._data.move_to_end(key)
+		while len(self._data) > self.max_entries:
+			self._data.popitem(last = False)
+
+	async def get(self, key):
+		return self._get(key)
+
+	async def set(self, key, value, ttl = None):
+		self._set(key, value, ttl)
+
+	async def delete(self, key):
+		self._data.pop(key, None)
+
+	async def incr(self, key, n = 1):
+		value = (self._get(key) or 0) + n
+		entry = self._data.get(key)
+		self._data[key] = (value, entry[1] if entry else None)
+		return value
+
+	async def publish(self, channel, message):
+		for callback in self._subscribers[channel]:
+			callback(message)
+
+	async def subscribe(self, channel, callback):
+		self._subscribers[channel].append(callback)
+
+'''
+Redis protocol (RESP) encoding
+'''
+
+def _encode(args):
+	L = [b'*%d\r\n' % len(args)]
+	for a in args:
+		if not isinstance(a, bytes):
+			a = str(a).encode('utf-8')
+		L.append(b'$%d\r\n%s\r\n' % (len(a), a))
+	return b''.join(L)
+
+async def _read_reply(reader):
+	line = await reader.readline()
+	if not line:
+		raise ConnectionError('connection closed')
+	kind, rest = line[:1], line[1:-2]
+	if kind == b'+':
+		return rest.decode('utf-8')
+	if kind == b'-':
+		raise CacheError(rest.decode('utf-8'))
+	if kind == b':':
+		return int(rest)
+	if kind == b'$':
+		n = int(rest)
+		if n < 0:
+			return None
+		data = await reader.readexactly(n + 2)
+		return data[:-2]
+	if kind == b'*':
+		n = int(rest)
+		if n < 0:
+			return None
+		return [await _read_reply(reader) for i in range(n)]
+	raise ConnectionError('invalid reply: %r' % line)
+
+class RedisCache(Cache):
+
+	def __init__(self, host = '127.0.0.1', port = 6379, db = 0, password = None, prefix = 'awesome:', **kw):
+		self.host = host
+		self.port = port
+		self.db = db
+		self.password = password
+		self.prefix = prefix
+		self._reader = None
+		self._writer = None
+		self._lock = asyncio.Lock()
+		self._subscriptions = []
+
+	async def _connect(self):
+		try:
+			reader, writer = await asyncio.open_connection(self.host, self.port)
+		except OSError as e:
+			raise CacheError('redis %s:%s: %s' % (self.host, self.port, e))
+		try:
+			if self.password:
+				writer.write(_encode(['AUTH', self.password]))
+				await _read_reply(reader)
+			if self.db:
+				writer.write(_encode(['SELECT', self.db]))
+				await _read_reply(reader)
+		except BaseException:
+			writer.close()
+			raise
+		return reader, writer
+
+	async def command(self, *args):
+		' send one command and return its reply, reconnecting when needed. '
+		async with self._lock:
+			if self._writer is None:
+				self._reader, self._writer = await self._connect()
+			try:
+				self._writer.write(_encode(args))
+				await self._writer.drain()
+				return await _read_reply(self._reader)
+			except CacheError:
+				# a parsed -ERR reply leaves the stream in step.
+				raise
+			except (OSError, asyncio.IncompleteReadError) as e:
+				self._reset()
+				raise CacheError('redis %s:%s: %s' % (self.host, self.port, e))
+			except BaseException:
+				# cancelled or timed out between the write and the reply: the
+				# reply would be read by the next command, so drop the connection.
+				self._reset()
+				raise
+
+	def _reset(self):
+		self._writer.close()
+		self._reader = self._writer = None
+
+	async def get(self, key):
+		data = await self.command('GET', self.prefix + key)
+		return None if data is None else json.loads(data.decode('utf-8'))
+
+	async def set(self, key, value, ttl = None):
+		args = ['SET', self.prefix + key, json.dumps(value)]
+		if ttl:
+			args.extend(['PX', int(ttl * 1000)])
+		await self.command(*args)
+
+	async def delete(self, key):
+		await self.command('DEL', self.prefix + key)
+
+	async def incr(self, key, n = 1):
+		return await self.command('INCRBY', self.prefix + key, n)
+
+	async def publish(self, channel, message):
+		await self.command('PUBLISH', self.prefix + channel, json.dumps(message))
+
+	async def subscribe(self, channel, callback):
+		self._subscriptions.append(asyncio.ensure_future(self._listen(self.prefix + channel, callback)))
+
+	async def _listen(self, channel, callback):
+		' a dedicated connection per subscription, reconnecting forever. '
+		while True:
+			writer = None
+			try:
+				reader, writer = await self._connect()
+				writer.write(_encode(['SUBSCRIBE', channel]))
+				await writer.drain()
+				while True:
+					reply = await _read_reply(reader)
+					if reply[0] == b'message':
+						callback(json.loads(reply[2].decode('utf-8')))
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logging.warning('redis subscription %s lost: %s' % (channel, e))
+			finally:
+				if writer is not None:
+					writer.close()
+			await asyncio.sleep(1)
+
+	async def close(self):
+		for task in self._subscriptions:
+			task.cancel()
+		if self._writer is not None:
+			self._writer.close()
+			self._reader = self._writer = None
+
+def create_cache(backend = 'memory', **kw):
+	if backend == 'memory':
+		return MemoryCache(**kw)
+	if backend == 'redis':
+		return RedisCache(**kw)
+	raise ValueError('Invalid cache backend: %s' % backend)
+
+# the cache configured for this process, see app.py
+_cache = MemoryCache()
+
+def get_cache():
+	return _cache
+
+def set_cache(cache):
+	global _cache
+	_cache = cache
+
+'''
+stand-in server: GET, SET (EX/PX), DEL, INCRBY, PUBLISH, SUBSCRIBE, PING,
+SELECT and AUTH over the Redis protocol, all in memory. For development
+and tests only.
+'''
+
+class StandInServer(object):
+
+	def __init__(self):
+		self.data = {}  # key => (value, expires)
+		self.channels = collections.defaultdict(set)
+
+	def _get(self, key):
+		entry = self.data.get(key)
+		if entry is None or (entry[1] is not None and entry[1] < time.time()):
+			self.data.pop(key, None)
+			return None
+		return entry[0]
+
+	async def handle(self, reader, writer):
+		try:
+			while True:
+				args = await _read_reply(reader)
+				writer.write(self.execute(args, writer))
+				await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			for subscribers in self.channels.values():
+				subscribers.discard(writer)
+			writer.close()
+
+	def execute(self, args, writer):
+		name = args[0].decode('utf-8').upper()
+		args = args[1:]
+		if name in ('PING', 'SELECT', 'AUTH'):
+			return b'+OK\r\n' if name != 'PING' else b'+PONG\r\n'
+		if name == 'GET':
+			value = self._get(args[0])
+			return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+		if name == 'SET':
+			expires = None
+			if len(args) >= 4:
+				unit = args[2].decode('utf-8').upper()
+				expires = time.time() + int(args[3]) / (1000.0 if unit == 'PX' else 1.0)
+			self.data[args[0]] = (args[1], expires)
+			return b'+OK\r\n'
+		if name == 'DEL':
+			n = sum(1 for k in args if self.data.pop(k, None) is not None)
+			return b':%d\r\n' % n
+		if name == 'INCRBY':
+			entry = self.data.get(args[0])
+			value = int(self._get(args[0]) or 0) + int(args[1])
+			self.data[args[0]] = (str(value).encode('utf-8'), entry[1] if entry else None)
+			return b':%d\r\n' % value
+		if name == 'PUBLISH':
+			subscribers = list(self.channels[args[0]])
+			for w in subscribers:
+				w.write(_encode([b'message', args[0], args[1]]))
+			return b':%d\r\n' % len(subscribers)
+		if name == 'SUBSCRIBE':
+			self.channels[args[0]].add(writer)
+			return b'*3\r\n$9\r\nsubscribe\r\n$%d\r\n%s\r\n:1\r\n' % (len(args[0]), args[0])
+		return b'-ERR unknown command %s\r\n' % name.encode('utf-8')
+
+async def start_stand_in(host = '127.0.0.1', port = 6379):
+	server = StandInServer()
+	return await asyncio.start_server(server.handle, host, port)
+
+if __name__ == '__main__':
+	import sys
+	logging.basicConfig(level = logging.INFO)
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 6379
+	loop = asyncio.get_event_loop()
+	loop.run_until_complete(start_stand_in(port = port))
+	logging.info('stand-in cache server at 127.0.0.1:%s' % port)
+	loop.run_forever()
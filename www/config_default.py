@@ -14,9 +14,62 @@ configs ={
 		'port': 3306,
 		'user': 'www',
 		'password': 'www',
-		'db': 'awesome'
+		'db': 'awesome',
+		# e.g. [{'host': '10.0.0.2'}], other settings are taken from above
+		'replicas': [],
+		'replica_max_lag': 5,
+		'replica_check_interval': 5,
+		'minsize': 1,
+		'maxsize': 10,
+		# seconds to wait for a free connection before failing
+		'acquire_timeout': 10,
+		# grow/shrink maxsize between minsize and adaptive_maxsize by the observed wait
+		'adaptive': False,
+		'adaptive_maxsize': 50,
+		'adaptive_interval': 10
+	},
+	'count_cache': {
+		'ttl': 60,
+		'estimate_threshold': 0
+	},
+	'query_cache': {
+		'max_entries': 1024,
+		'max_bytes': 16 * 1024 * 1024,
+		# seconds, for writes of processes which do not share the cache
+		'ttl': 30
+	},
+	# 'memory' for one process, 'redis' (host, port, db, password) to share it between processes
+	'cache': {
+		'backend': 'memory'
+	},
+	'markdown': {
+		# size of the cache of rendered blogs
+		'cache_bytes': 32 * 1024 * 1024,
+		# store the rendered HTML in blogs.content_html on create/update
+		'persist_html': False,
+		# worker processes rendering long blogs, None for one per CPU, 0 to render inline
+		'workers': 2,
+		# blogs shorter than this many characters are rendered inline
+		'offload_threshold': 20000,
+		# seconds before giving up and showing the plain text
+		'render_timeout': 5,
+		# longer blogs (characters) are shown as plain text
+		'max_size': 1024 * 1024,
+		# seconds of rendering before falling back to plain text
+		'time_budget': 2,
+		# markdown2 extras of blogs, e.g. ['fenced-code-blocks'] for highlighted code
+		'extras': [],
+		# size of the cache of highlighted code blocks, per process
+		'highlight_cache_bytes': 8 * 1024 * 1024
 	},
 	'session':{
-		'secret': 'Awesome'
+		'secret': 'Awesome',
+		# verified sessions are cached for cache_ttl seconds
+		'cache_ttl': 300,
+		'cache_size': 10000,
+		# keep session generations in users.session_generation (see readme.md);
+		# otherwise they only live in the shared cache and a revocation lasts
+		# as long as the cache keeps it
+		'store_generations': False
 	}
 }
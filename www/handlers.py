@@ -5,9 +5,9 @@ __author__ = 'Yihang Ding'
 
 ' url handlers '
 
-import re, time, json, logging, hashlib, base64, asyncio
+import re, time, json, logging, hashlib, hmac, base64, asyncio, collections
 
-import markdown2
+from render import markdown_to_html, render_markdown, text2html, html_cache_stats, render_stats
 
 from coroweb import get, post
 
@@ -15,9 +15,13 @@ from aiohttp import web
 
 from config import configs
 
+import orm, cache
+
+from orm import Expr
+
 from models import User, Comment, Blog, next_id
 
-from apis import APIValueError, APIResourceNotFoundError, APIPermissionError,APIError, Page
+from apis import APIValueError, APIResourceNotFoundError, APIPermissionError,APIError, Page, CursorPage
 
 COOKIE_NAME = 'awesession'
 _COOKIE_KEY = configs.session.secret
@@ -32,6 +36,14 @@ def get_page_index(page_str):
 		p = 1
 	return p
 
+async def find_page_by_cursor(cls, cursor, where = None, args = None, **kw):
+	'''
+	Load one page of cls by keyset pagination on (created_at, id).
+	'''
+	p = CursorPage(cursor)
+	items = await cls.findAll(where, args, orderBy='created_at desc, id desc', limit=p.limit, seek=p.seek, **kw)
+	return p, p.paginate(items)
+
 def user2cookie(user, max_age):
 	'''
 	Generate cookie str by user.
@@ -42,12 +54,185 @@ def user2cookie(user, max_age):
 	L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
 	return '-'.join(L)
 
+class SessionCache(object):
+	'''
+	Bounded LRU of verified sessions: cookie => (user, expires), so that a
+	valid cookie costs neither User.find() nor a SHA1 until the entry
+	expires (after ttl seconds, or with the cookie).
+	'''
+	def __init__(self, max_entries = 10000, ttl = 300):
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self._sessions = collections.OrderedDict()
+		self._cookies = collections.defaultdict(set)  # uid => cookies
+
+	def get(self, cookie_str):
+		entry = self._sessions.get(cookie_str)
+		if entry is None:
+			return None
+		if entry[1] < time.time():
+			self.invalidate(cookie_str)
+			return None
+		self._sessions.move_to_end(cookie_str)
+		return User(**entry[0])
+
+	def put(self, cookie_str, user, expires):
+		self._sessions[cookie_str] = (dict(user), min(expires, time.time() + self.ttl))
+		self._cookies[user.id].add(cookie_str)
+		while len(self._sessions) > self.max_entries:
+			self.invalidate(next(iter(self._sessions)))
+
+	def invalidate(self, cookie_str):
+		entry = self._sessions.pop(cookie_str, None)
+		if entry is not None:
+			cookies = self._cookies.get(entry[0]['id'])
+			if cookies is not None:
+				cookies.discard(cookie_str)
+				if not cookies:
+					del self._cookies[entry[0]['id']]
+
+	def invalidate_user(self, uid):
+		for cookie_str in list(self._cookies.get(uid, ())):
+			self.invalidate(cookie_str)
+
+_sessions = SessionCache(configs.session.cache_size, configs.session.cache_ttl)
+
+'''
+other processes are told about signouts and deleted users over the shared cache
+'''
+
+SESSION_CHANNEL = 'session:invalidate'
+
+async def subscribe_session_invalidations():
+	await cache.get_cache().subscribe(SESSION_CHANNEL, _on_session_invalidate)
+
+def _on_session_invalidate(message):
+	if 'uid' in message:
+		_sessions.invalidate_user(message['uid'])
+		_generations.pop(message['uid'], None)
+	else:
+		_sessions.invalidate(message['cookie'])
+
+async def invalidate_sessions(uid = None, cookie_str = None):
+	'''
+	Forget cached sessions of a user (delete, password change) or of one cookie (signout).
+	For a user, the session generation is bumped as well, which revokes all of
+	the signed tokens issued to the user so far.
+	'''
+	if uid is not None:
+		await _bump_generation(uid)
+		message = dict(uid=uid)
+	else:
+		message = dict(cookie=cookie_str)
+	_on_session_invalidate(message)
+	try:
+		await cache.get_cache().publish(SESSION_CHANNEL, message)
+	except Exception as e:
+		logging.warning('failed to publish session invalidation: %s' % e)
+
+'''
+Signed session tokens: '2.<payload>.<hmac>', the payload carries uid, expires,
+admin, name, image and the session generation of the user, so cookie2user()
+can verify a token without the database. With session.store_generations the
+generation of every user is stored in users.session_generation, cached for
+session.cache_ttl seconds in the shared cache and mirrored here; without it
+the generation only lives in the shared cache. invalidate_sessions() bumps it.
+'''
+
+SESSION_VERSION = '2'
+
+_generations = {}  # uid => (session generation, expires)
+
+# the cached generation of a user which does not exist
+_NO_USER = -1
+
+def _generation_key(uid):
+	return 'session:generation:%s' % uid
+
+async def session_generation(uid):
+	'''
+	The session generation of a user, None if there is no such user. With
+	session.store_generations a generation missing from the cache is read
+	from the primary database, never assumed.
+	'''
+	entry = _generations.get(uid)
+	if entry is not None and entry[1] > time.time():
+		g = entry[0]
+	else:
+		key = _generation_key(uid)
+		g = await cache.get_cache().get(key)
+		if g is None and configs.session.store_generations:
+			with orm.read_primary():
+				user = await User.find(uid)
+			g = _NO_USER if user is None else user.session_generation
+			await cache.get_cache().set(key, g, configs.session.cache_ttl)
+		elif g is None:
+			g = 0
+		if len(_generations) >= configs.session.cache_size:
+			_generations.clear()
+		_generations[uid] = (g, time.time() + configs.session.cache_ttl)
+	return None if g == _NO_USER else g
+
+async def _bump_generation(uid):
+	if configs.session.store_generations:
+		await User.updateWhere(dict(session_generation=Expr('`session_generation` + 1')), '`id`=?', [uid])
+		await cache.get_cache().delete(_generation_key(uid))
+	else:
+		await cache.get_cache().incr(_generation_key(uid))
+	_generations.pop(uid, None)
+
+def _sign(payload):
+	return hmac.new(_COOKIE_KEY.encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+async def user2token(user, max_age):
+	'''
+	Generate a signed session token by user.
+	'''
+	expires = int(time.time() + max_age)
+	data = [user.id, expires, bool(user.admin), user.name, user.image, await session_generation(user.id)]
+	payload = base64.urlsafe_b64encode(json.dumps(data, ensure_ascii=False).encode('utf-8')).decode('ascii').rstrip('=')
+	return '%s.%s.%s' % (SESSION_VERSION, payload, _sign(payload))
+
+async def token2user(token):
+	'''
+	Verify a signed session token in memory. The returned User only has
+	id, name, admin and image, the other fields are deferred and can be
+	loaded with User.loadDeferred([user]) by handlers which need them.
+	'''
+	L = token.split('.')
+	if len(L) != 3:
+		return None
+	version, payload, signature = L
+	if not hmac.compare_digest(signature, _sign(payload)):
+		logging.info('invalid session signature')
+		return None
+	uid, expires, admin, name, image, generation = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+	if expires < time.time():
+		return None
+	current = await session_generation(uid)
+	if current is None or generation != current:
+		logging.info('revoked session of user %s' % uid)
+		return None
+	user = User(id=uid, admin=admin, name=name, image=image)
+	user.__deferred__ = frozenset(User.__fields__) - frozenset(('admin', 'name', 'image'))
+	return user
+
 async def cookie2user(cookie_str):
 	'''
 	Parse cookie and load user if cookie is valid.
 	'''
 	if not cookie_str:
 		return None
+	if cookie_str.startswith(SESSION_VERSION + '.'):
+		try:
+			return await token2user(cookie_str)
+		except Exception as e:
+			logging.exception(e)
+			return None
+	# cookies of the old 'id-expires-sha1' format stay valid until they expire
+	user = _sessions.get(cookie_str)
+	if user is not None:
+		return user
 	try:
 		L = cookie_str.split('-')
 		if len(L) != 3:
@@ -63,15 +248,12 @@ async def cookie2user(cookie_str):
 			logging.info('invalid sha1')
 			return None
 		user.passwd = '******'
+		_sessions.put(cookie_str, user, int(expires))
 		return user
 	except Exception as e:
 		logging.exception(e)
 		return None
 
-def text2html(text):
-	lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
-	return ''.join(lines)
-
 _RE_EMAIL = re.compile(r'^[a-z0-9\.\-\_]+\@[a-z0-9\-\_]+(\.[a-z0-9\-\_]+){1,4}$')
 _RE_SHA1 = re.compile(r'^[0-9a-z]{40}$')
 
@@ -80,7 +262,14 @@ def check_admin(request):
 		raise APIPermissionError()
 
 @get('/')  # the main page
-async def index(*, page='1'):
+async def index(*, page='1', cursor=None):
+	if cursor is not None:
+		page, blogs = await find_page_by_cursor(Blog, cursor, defer=['content', 'content_html'], rows=True, cache=True)
+		return {
+				'__template__':'blogs.html',
+				'page':page,
+				'blogs':blogs
+		}
 	page_index = get_page_index(page)
 	num = await Blog.findNumber('count(id)')
 	page = Page(num, page_index)
@@ -88,7 +277,7 @@ async def index(*, page='1'):
 	if num == 0:
 		blogs = []
 	else:
-		blogs = await Blog.findAll(orderBy='created_at desc', limit=(page.offset, page.limit))
+		blogs = await Blog.findAll(orderBy='created_at desc', defer=['content', 'content_html'], rows=True, cache=True, limit=(page.offset, page.limit))
 	return {
 			'__template__':'blogs.html',
 			'page':page,
@@ -98,10 +287,10 @@ async def index(*, page='1'):
 @get('/blog/{id}') # the specific blog with id {id}
 async def get_blog(id):
 	blog = await Blog.find(id)
-	comments = await Comment.findAll('blog_id=?',[id],orderBy='created_at desc')
+	comments = await Comment.findAll('blog_id=?',[id],orderBy='created_at desc', cache=True)
 	for c in comments:
 		c.html_content = text2html(c.content)
-	blog.html_content = markdown2.markdown(blog.content)
+	blog.html_content = blog.get('content_html') or await markdown_to_html(blog.content)
 	return {
 			'__template__':'blog.html',
 			'blog':blog,
@@ -121,7 +310,10 @@ def signin():
 	}
 
 @get('/signout') #signout
-def signout(request):
+async def signout(request):
+	cookie_str = request.cookies.get(COOKIE_NAME)
+	if cookie_str:
+		await invalidate_sessions(cookie_str=cookie_str)
 	referer = request.headers.get('Referer')
 	r = web.HTTPFound(referer or '/')
 	r.set_cookie(COOKIE_NAME, '-deleted-', max_age = 0, httponly=True)
@@ -225,7 +417,7 @@ async def api_register_user(*,email, name, passwd):
 	await user.save()
 	# make session cookie:
 	r = web.Response()
-	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400,httponly=True)
+	r.set_cookie(COOKIE_NAME, await user2token(user, 86400), max_age=86400,httponly=True)
 	user.passwd = '******'
 	r.content_type = 'application/json'
 	r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
@@ -250,7 +442,7 @@ async def authenticate(*, email, passwd):
 		raise APIValueError('passwd', 'Invalid password!')
 	# set cookie
 	r = web.Response()
-	r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+	r.set_cookie(COOKIE_NAME, await user2token(user, 86400), max_age=86400, httponly=True)
 	logging.info('%s: sign in and generate cookies successfully.' % user.name)
 	user.passwd = '******'
 	r.content_type = 'application/json'
@@ -275,17 +467,20 @@ async def api_update_blog(id, request,*, name, summary, content):
 	blog.name = name.strip()
 	blog.summary = summary.strip()
 	blog.content = content.strip()
+	if configs.markdown.persist_html:
+		html, final = await render_markdown(blog.content)
+		# leave a fallback unsaved, get_blog renders it again
+		blog.content_html = html if final else None
 	await blog.update()
 	return blog
 
 @post('/api/blogs/{id}/delete') # api for deleting a blog
 async def api_delete_blog(request, *, id):
 	check_admin(request)
-	blog = await Blog.find(id)
-	await blog.remove()
-	comments = await Comment.findAll('blog_id=?',[id])
-	for comment in comments:
-		await comment.remove()
+	async with orm.transaction():
+		blog = await Blog.find(id)
+		await blog.remove()
+		await Comment.removeWhere('`blog_id`=?', [id])
 	return dict(id=id)
 
 @post('/api/blogs')  # api for creating a new blog
@@ -304,32 +499,42 @@ async def api_create_blog(request, *, name, summary, content):
 				summary=summary.strip(),
 				content=content.strip()
 				)
+	if configs.markdown.persist_html:
+		html, final = await render_markdown(blog.content)
+		# leave a fallback unsaved, get_blog renders it again
+		blog.content_html = html if final else None
 	await blog.save()
 	return blog
 
 @get('/api/blogs') # api for management of blogs
-async def api_blogs(*, page = '1'):
+async def api_blogs(*, page = '1', cursor = None):
+	if cursor is not None:
+		p, blogs = await find_page_by_cursor(Blog, cursor, defer=['content', 'content_html'], rows=True)
+		return dict(page=p, blogs=blogs)
 	page_index = get_page_index(page)
 	num = await Blog.findNumber('count(id)')
 	p = Page(num, page_index)
 	if num == 0:
 		return dict(page=p, blogs=())
-	blogs = await Blog.findAll(orderBy='created_at desc', limit = (p.offset, p.limit))
+	blogs = await Blog.findAll(orderBy='created_at desc', defer=['content', 'content_html'], rows=True, limit = (p.offset, p.limit))
 	return dict(page=p, blogs=blogs)
 
 @get('/api/comments') # api for management of comments
-async def api_comments(*, page = '1'):
-	page_index = get_page_index(page)
-	num = await Comment.findNumber('count(id)')
-	p = Page(num, page_index)
-	if num == 0:
-		return dict(page=p, comments=())
-	comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_comments(*, page = '1', cursor = None):
+	if cursor is not None:
+		p, comments = await find_page_by_cursor(Comment, cursor)
+	else:
+		page_index = get_page_index(page)
+		num = await Comment.findNumber('count(id)')
+		p = Page(num, page_index)
+		if num == 0:
+			return dict(page=p, comments=())
+		comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+	# 找对应的文章: load all blogs of this page with one query
+	blogs = await Blog.findByIds((c.blog_id for c in comments), columns=['name'])
 	for comment in comments:
-		# 找对应的文章
-		id = comment.blog_id
-		blog = await Blog.find(id)
-		comment['blog_name'] = blog.name
+		blog = blogs.get(comment.blog_id)
+		comment['blog_name'] = blog.name if blog else ''
 	return dict(page=p, comments=comments)
 
 @post('/api/comments/{id}/delete') # api for deleting a comment
@@ -344,20 +549,14 @@ async def api_delete_comments(id, request):
 @post('/api/users/{id}/delete') # api for deleting an user
 async def api_delete_users(id, request):
 	check_admin(request)
-	id_buff = id
-	user = await User.find(id)
-	if user is None:
-		raise APIResourceNotFoundError('Comment')
-	await user.remove()
-	# 给被删除的用户在评论中标记
-	comments = await Comment.findAll('user_id=?',[id])
-	if comments:
-		for comment in comments:
-			id = comment.id
-			c = await Comment.find(id)
-			c.user_name = c.user_name + ' (该用户已被删除)'
-			await c.update()
-	id = id_buff
+	async with orm.transaction():
+		user = await User.find(id)
+		if user is None:
+			raise APIResourceNotFoundError('Comment')
+		await user.remove()
+		# 给被删除的用户在评论中标记
+		await Comment.updateWhere(dict(user_name=Expr('CONCAT(`user_name`, ?)', ' (该用户已被删除)')), '`user_id`=?', [id])
+	await invalidate_sessions(uid=id)
 	return dict(id=id)
 
 
@@ -376,14 +575,26 @@ async def api_create_comment(id, request, *, content):
 	return comment
 
 @get('/api/users')   # api for management of users
-async def api_get_users(*, page='1'):
-	
-	page_index = get_page_index(page)
-	num = await User.findNumber('count(id)')
-	p = Page(num, page_index)
-	if num == 0:
-		return dict(page=p, users=())
-	users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+async def api_get_users(*, page='1', cursor=None):
+	if cursor is not None:
+		p, users = await find_page_by_cursor(User, cursor)
+	else:
+		page_index = get_page_index(page)
+		num = await User.findNumber('count(id)')
+		p = Page(num, page_index)
+		if num == 0:
+			return dict(page=p, users=())
+		users = await User.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
 	for u in users:
 		u['passwd'] = '******'
-	return dict(page=p, users=users)
\ No newline at end of file
+	return dict(page=p, users=users)
+
+@get('/api/pool')   # api for connection pool metrics
+async def api_pool_stats(request):
+	check_admin(request)
+	return dict(pools=orm.pool_stats())
+
+@get('/api/cache')   # api for query cache and rendering metrics
+async def api_cache_stats(request):
+	check_admin(request)
+	return dict(query_cache=orm.query_cache_stats(), html_cache=html_cache_stats(), render=render_stats())
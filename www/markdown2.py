@@ -101,6 +101,9 @@ except ImportError:
 import optparse
 from random import random, randint
 import codecs
+import time
+import threading
+from collections import OrderedDict
 
 
 #---- Python version compat
@@ -138,8 +141,12 @@ log = logging.getLogger("markdown")
 
 DEFAULT_TAB_WIDTH = 4
 
+# Loops over the text check the time budget every this many steps.
+BUDGET_CHECK_STEPS = 16
 
-SECRET_SALT = bytes(randint(0, 1000000))
+
+# bytes(n) would be n zero bytes, hashed along with every text
+SECRET_SALT = str(randint(0, 1000000)).encode("utf-8")
 def _hash_text(s):
     return 'md5-' + md5(SECRET_SALT + s.encode("utf-8")).hexdigest()
 
@@ -154,6 +161,14 @@ g_escape_table = dict([(ch, _hash_text(ch))
 class MarkdownError(Exception):
     pass
 
+class MarkdownBudgetExceeded(MarkdownError):
+    """A conversion ran over its `time_budget`. `stage` is the
+    processing stage after which this was noticed.
+    """
+    def __init__(self, stage):
+        MarkdownError.__init__(self, "over budget after %s" % stage)
+        self.stage = stage
+
 
 
 #---- public api
@@ -161,22 +176,24 @@ class MarkdownError(Exception):
 def markdown_path(path, encoding="utf-8",
                   html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
                   safe_mode=None, extras=None, link_patterns=None,
-                  use_file_vars=False):
+                  use_file_vars=False, max_size=None, time_budget=None):
     fp = codecs.open(path, 'r', encoding)
     text = fp.read()
     fp.close()
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    max_size=max_size, time_budget=time_budget).convert(text)
 
 def markdown(text, html4tags=False, tab_width=DEFAULT_TAB_WIDTH,
              safe_mode=None, extras=None, link_patterns=None,
-             use_file_vars=False):
+             use_file_vars=False, max_size=None, time_budget=None):
     return Markdown(html4tags=html4tags, tab_width=tab_width,
                     safe_mode=safe_mode, extras=extras,
                     link_patterns=link_patterns,
-                    use_file_vars=use_file_vars).convert(text)
+                    use_file_vars=use_file_vars,
+                    max_size=max_size, time_budget=time_budget).convert(text)
 
 class Markdown(object):
     # The dict of "extras" to enable in processing -- a mapping of
@@ -199,8 +216,18 @@ class Markdown(object):
 
     _ws_only_line_re = re.compile(r"^[ \t]+$", re.M)
 
+    # The deadline of the current conversion when it has a `time_budget`.
+    _deadline = None
+
     def __init__(self, html4tags=False, tab_width=4, safe_mode=None,
-                 extras=None, link_patterns=None, use_file_vars=False):
+                 extras=None, link_patterns=None, use_file_vars=False,
+                 max_size=None, time_budget=None):
+        """`max_size` (characters) and `time_budget` (seconds) bound the
+        work spent on one document. A document over either is returned as
+        escaped plain text paragraphs with a `budget_exceeded` attribute
+        naming the stage that ran over. The time budget is checked between
+        stages, a single regex stage cannot be interrupted.
+        """
         if html4tags:
             self.empty_element_suffix = ">"
         else:
@@ -231,6 +258,8 @@ class Markdown(object):
 
         self.link_patterns = link_patterns
         self.use_file_vars = use_file_vars
+        self.max_size = max_size
+        self.time_budget = time_budget
         self._outdent_re = re.compile(r'^(\t|[ ]{1,%d})' % tab_width, re.M)
 
         self._escape_table = g_escape_table.copy()
@@ -244,6 +273,7 @@ class Markdown(object):
         self.html_blocks = {}
         self.html_spans = {}
         self.list_level = 0
+        self._toc = None
         self.extras = self._instance_extras.copy()
         if "footnotes" in self.extras:
             self.footnotes = {}
@@ -274,6 +304,19 @@ class Markdown(object):
             #TODO: perhaps shouldn't presume UTF-8 for string input?
             text = unicode(text, 'utf-8')
 
+        if self.max_size is not None and len(text) > self.max_size:
+            return self._plain_text(text, "size")
+        if self.time_budget is None:
+            return self._convert(text)
+        self._deadline = time.time() + self.time_budget
+        try:
+            return self._convert(text)
+        except MarkdownBudgetExceeded as ex:
+            return self._plain_text(text, ex.stage)
+        finally:
+            self._deadline = None
+
+    def _convert(self, text):
         if self.use_file_vars:
             # Look for emacs-style file variable hints.
             emacs_vars = self._get_emacs_vars(text)
@@ -319,6 +362,7 @@ class Markdown(object):
 
         # Turn block-level HTML blocks into hash entries
         text = self._hash_html_blocks(text, raw=True)
+        self._check_budget("html_blocks")
 
         if "fenced-code-blocks" in self.extras and self.safe_mode:
             text = self._do_fenced_code_blocks(text)
@@ -355,6 +399,55 @@ class Markdown(object):
             rv.metadata = self.metadata
         return rv
 
+    def _check_budget(self, stage, step=0):
+        """Raise MarkdownBudgetExceeded past the deadline. Loops pass
+        their step count and only check every BUDGET_CHECK_STEPS steps.
+        """
+        if self._deadline is None or step % BUDGET_CHECK_STEPS:
+            return
+        if time.time() > self._deadline:
+            raise MarkdownBudgetExceeded(stage)
+
+    def _sub_within_budget(self, regex, repl, text, start_re, stage):
+        """`regex.sub(repl, text)`, trying one candidate start at a time
+        so that the time budget is checked while a badly backtracking regex
+        runs. Every match of `regex` must start with a match of `start_re`.
+        """
+        if self._deadline is None:
+            return regex.sub(repl, text)
+        chunks = []
+        done = pos = 0
+        step = 0
+        while True:
+            start = start_re.search(text, pos)
+            if start is None:
+                break
+            step += 1
+            self._check_budget(stage, step)
+            match = regex.match(text, start.start())
+            if match is None:
+                pos = start.start() + 1
+                continue
+            chunks.append(text[done:match.start()])
+            chunks.append(match.expand(repl))
+            done = pos = match.end()
+        if not chunks:
+            return text
+        chunks.append(text[done:])
+        return ''.join(chunks)
+
+    def _plain_text(self, text, stage):
+        """The fallback for documents over budget: each non-blank line
+        as an escaped paragraph, no markdown.
+        """
+        log.warning("markdown over budget after %s, %d characters",
+                    stage, len(text))
+        lines = [line.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                 for line in text.splitlines() if line.strip()]
+        rv = UnicodeWithAttrs(''.join('<p>%s</p>\n' % line for line in lines))
+        rv.budget_exceeded = stage
+        return rv
+
     def postprocess(self, text):
         """A hook for subclasses to do some postprocessing of the html, if
         desired. This is called before unescaping of special chars and
@@ -708,28 +801,9 @@ class Markdown(object):
     def _strip_link_definitions(self, text):
         # Strips link definitions from text, stores the URLs and titles in
         # hash references.
-        less_than_tab = self.tab_width - 1
-
         # Link defs are in the form:
         #   [id]: url "optional title"
-        _link_def_re = re.compile(r"""
-            ^[ ]{0,%d}\[(.+)\]: # id = \1
-              [ \t]*
-              \n?               # maybe *one* newline
-              [ \t]*
-            <?(.+?)>?           # url = \2
-              [ \t]*
-            (?:
-                \n?             # maybe one newline
-                [ \t]*
-                (?<=\s)         # lookbehind for whitespace
-                ['"(]
-                ([^\n]*)        # title = \3
-                ['")]
-                [ \t]*
-            )?  # title is optional
-            (?:\n+|\Z)
-            """ % less_than_tab, re.X | re.M | re.U)
+        _link_def_re = _link_def_re_from_tab_width(self.tab_width)
         return _link_def_re.sub(self._extract_link_def_sub, text)
 
     def _extract_link_def_sub(self, match):
@@ -764,22 +838,7 @@ class Markdown(object):
             [^note-id]:
                 Text of the note.
         """
-        less_than_tab = self.tab_width - 1
-        footnote_def_re = re.compile(r'''
-            ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
-            [ \t]*
-            (                       # footnote text = \2
-              # First line need not start with the spaces.
-              (?:\s*.*\n+)
-              (?:
-                (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
-                .*\n+
-              )*
-            )
-            # Lookahead for non-space at line-start, or end of doc.
-            (?:(?=^[ ]{0,%d}\S)|\Z)
-            ''' % (less_than_tab, self.tab_width, self.tab_width),
-            re.X | re.M)
+        footnote_def_re = _footnote_def_re_from_tab_width(self.tab_width)
         return footnote_def_re.sub(self._extract_footnote_def_sub, text)
 
     _hr_re = re.compile(r'^[ ]{0,3}([-_*][ ]{0,2}){3,}$', re.M)
@@ -802,6 +861,7 @@ class Markdown(object):
         text = re.sub(self._hr_re, hr, text)
 
         text = self._do_lists(text)
+        self._check_budget("lists")
 
         if "pyshell" in self.extras:
             text = self._prepare_pyshell_blocks(text)
@@ -809,16 +869,20 @@ class Markdown(object):
             text = self._do_wiki_tables(text)
         if "tables" in self.extras:
             text = self._do_tables(text)
+        self._check_budget("tables")
 
         text = self._do_code_blocks(text)
+        self._check_budget("code_blocks")
 
         text = self._do_block_quotes(text)
+        self._check_budget("block_quotes")
 
         # We already ran _HashHTMLBlocks() before, in Markdown(), but that
         # was to escape raw HTML in the original Markdown source. This time,
         # we're escaping the markup we've just created, so that we don't wrap
         # <p> tags around block-level tags.
         text = self._hash_html_blocks(text)
+        self._check_budget("html_blocks")
 
         text = self._form_paragraphs(text)
 
@@ -894,29 +958,7 @@ class Markdown(object):
         """Copying PHP-Markdown and GFM table syntax. Some regex borrowed from
         https://github.com/michelf/php-markdown/blob/lib/Michelf/Markdown.php#L2538
         """
-        less_than_tab = self.tab_width - 1
-        table_re = re.compile(r'''
-                (?:(?<=\n\n)|\A\n?)             # leading blank line
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (.*[|].*)  \n                   # $1: header row (at least one pipe)
-
-                ^[ ]{0,%d}                      # allowed whitespace
-                (                               # $2: underline row
-                    # underline row with leading bar
-                    (?:  \|\ *:?-+:?\ *  )+  \|?  \n
-                    |
-                    # or, underline row without leading bar
-                    (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
-                )
-
-                (                               # $3: data rows
-                    (?:
-                        ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
-                        .*\|.*  \n
-                    )+
-                )
-            ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+        table_re = _table_re_from_tab_width(self.tab_width)
         return table_re.sub(self._table_sub, text)
 
     def _wiki_table_sub(self, match):
@@ -945,12 +987,7 @@ class Markdown(object):
         if "||" not in text:
             return text
 
-        less_than_tab = self.tab_width - 1
-        wiki_table_re = re.compile(r'''
-            (?:(?<=\n\n)|\A\n?)            # leading blank line
-            ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
-            (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
-            ''' % less_than_tab, re.M | re.X)
+        wiki_table_re = _wiki_table_re_from_tab_width(self.tab_width)
         return wiki_table_re.sub(self._wiki_table_sub, text)
 
     def _run_span_gamut(self, text):
@@ -958,11 +995,14 @@ class Markdown(object):
         # tags like paragraphs, headers, and list items.
 
         text = self._do_code_spans(text)
+        self._check_budget("code_spans")
 
         text = self._escape_special_chars(text)
+        self._check_budget("escape_special_chars")
 
         # Process anchor and image tags.
         text = self._do_links(text)
+        self._check_budget("links")
 
         # Make links out of things like `<http://example.com/>`
         # Must come after _do_links(), because you can use < and >
@@ -975,6 +1015,7 @@ class Markdown(object):
         text = self._encode_amps_and_angles(text)
 
         text = self._do_italics_and_bold(text)
+        self._check_budget("italics_and_bold")
 
         if "smarty-pants" in self.extras:
             text = self._do_smart_punctuation(text)
@@ -1014,7 +1055,8 @@ class Markdown(object):
         # here.
         escaped = []
         is_html_markup = False
-        for token in self._sorta_html_tokenize_re.split(text):
+        for step, token in enumerate(self._sorta_html_tokenize_re.split(text)):
+            self._check_budget("escape_special_chars", step + 1)
             if is_html_markup:
                 # Within tags/HTML-comments/auto-links, encode * and _
                 # so they don't conflict with their use in Markdown for
@@ -1137,7 +1179,7 @@ class Markdown(object):
             url = self._strip_anglebrackets.sub(r'\1', url)
         return url, title, end_idx
 
-    def _do_links(self, text):
+    def _do_links(self, text, anchors=True):
         """Turn Markdown link shortcuts into XHTML <a> and <img> tags.
 
         This is a combination of Markdown.pl's _DoAnchors() and
@@ -1145,16 +1187,22 @@ class Markdown(object):
         approach. It was necessary to use a different approach than
         Markdown.pl because of the lack of atomic matching support in
         Python's regex engine used in $g_nested_brackets.
+
+        The output is collected in `chunks` instead of being spliced back
+        into `text`, which keeps this linear in the length of the text.
+        The text of an anchor is processed by a recursive call with
+        `anchors` false, to support img links inside anchors, but not
+        anchors inside anchors.
         """
         MAX_LINK_TEXT_SENTINEL = 3000  # markdown2 issue 24
 
-        # `anchor_allowed_pos` is used to support img links inside
-        # anchors, but not anchors inside anchors. An anchor's start
-        # pos must be `>= anchor_allowed_pos`.
-        anchor_allowed_pos = 0
-
+        chunks = []
+        done = 0    # text[:done] has been replaced by `chunks`
         curr_pos = 0
+        step = 0
         while True: # Handle the next link.
+            step += 1
+            self._check_budget("links", step)
             # The next '[' is the start of:
             # - an inline anchor:   [text](url "title")
             # - a reference anchor: [text][id]
@@ -1206,7 +1254,9 @@ class Markdown(object):
                     result = '<sup class="footnote-ref" id="fnref-%s">' \
                              '<a href="#fn-%s">%s</a></sup>' \
                              % (normed_id, normed_id, len(self.footnote_ids))
-                    text = text[:start_idx] + result + text[p+1:]
+                    chunks.append(text[done:start_idx])
+                    chunks.append(result)
+                    done = curr_pos = p+1
                 else:
                     # This id isn't defined, leave the markup alone.
                     curr_pos = p+1
@@ -1215,7 +1265,7 @@ class Markdown(object):
             # Now determine what this is by the remainder.
             p += 1
             if p == text_length:
-                return text
+                break
 
             # Inline anchor or img?
             if text[p] == '(': # attempt at perf improvement
@@ -1245,18 +1295,19 @@ class Markdown(object):
                                title_str, img_class_str, self.empty_element_suffix)
                         if "smarty-pants" in self.extras:
                             result = result.replace('"', self._escape_table['"'])
-                        curr_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
-                    elif start_idx >= anchor_allowed_pos:
+                        chunks.append(text[done:start_idx])
+                        chunks.append(result)
+                        done = curr_pos = url_end_idx
+                    elif anchors:
                         result_head = '<a href="%s"%s>' % (url, title_str)
-                        result = '%s%s</a>' % (result_head, link_text)
                         if "smarty-pants" in self.extras:
-                            result = result.replace('"', self._escape_table['"'])
-                        # <img> allowed from curr_pos on, <a> from
-                        # anchor_allowed_pos on.
-                        curr_pos = start_idx + len(result_head)
-                        anchor_allowed_pos = start_idx + len(result)
-                        text = text[:start_idx] + result + text[url_end_idx:]
+                            result_head = result_head.replace('"', self._escape_table['"'])
+                            link_text = link_text.replace('"', self._escape_table['"'])
+                        result = '%s%s</a>' % (result_head,
+                            self._do_links(link_text, anchors=False))
+                        chunks.append(text[done:start_idx])
+                        chunks.append(result)
+                        done = curr_pos = url_end_idx
                     else:
                         # Anchor not allowed here.
                         curr_pos = start_idx + 1
@@ -1296,20 +1347,19 @@ class Markdown(object):
                                    title_str, img_class_str, self.empty_element_suffix)
                             if "smarty-pants" in self.extras:
                                 result = result.replace('"', self._escape_table['"'])
-                            curr_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
-                        elif start_idx >= anchor_allowed_pos:
-                            result = '<a href="%s"%s>%s</a>' \
-                                % (url, title_str, link_text)
+                            chunks.append(text[done:start_idx])
+                            chunks.append(result)
+                            done = curr_pos = match.end()
+                        elif anchors:
                             result_head = '<a href="%s"%s>' % (url, title_str)
-                            result = '%s%s</a>' % (result_head, link_text)
                             if "smarty-pants" in self.extras:
-                                result = result.replace('"', self._escape_table['"'])
-                            # <img> allowed from curr_pos on, <a> from
-                            # anchor_allowed_pos on.
-                            curr_pos = start_idx + len(result_head)
-                            anchor_allowed_pos = start_idx + len(result)
-                            text = text[:start_idx] + result + text[match.end():]
+                                result_head = result_head.replace('"', self._escape_table['"'])
+                                link_text = link_text.replace('"', self._escape_table['"'])
+                            result = '%s%s</a>' % (result_head,
+                                self._do_links(link_text, anchors=False))
+                            chunks.append(text[done:start_idx])
+                            chunks.append(result)
+                            done = curr_pos = match.end()
                         else:
                             # Anchor not allowed here.
                             curr_pos = start_idx + 1
@@ -1321,7 +1371,10 @@ class Markdown(object):
             # Otherwise, it isn't markup.
             curr_pos = start_idx + 1
 
-        return text
+        if not chunks:
+            return text
+        chunks.append(text[done:])
+        return ''.join(chunks)
 
     def header_id_from_text(self, text, prefix, n):
         """Generate a header id attribute value from the given header
@@ -1430,54 +1483,38 @@ class Markdown(object):
     def _do_lists(self, text):
         # Form HTML ordered (numbered) and unordered (bulleted) lists.
 
-        # Iterate over each *non-overlapping* list match.
+        # Iterate over each *non-overlapping* list match. The output is
+        # collected in `chunks` rather than spliced back into `text`, so
+        # this stays linear in the length of the text.
+        chunks = []
         pos = 0
+        list_res = _list_res_from_tab_width(self.tab_width, bool(self.list_level))
+        # The next hit of each list style, searched again only once the
+        # previous one has been consumed. None means no hit until the end.
+        hits = [list_re.search(text) for list_re in list_res]
+        step = 0
         while True:
+            step += 1
+            self._check_budget("lists", step)
             # Find the *first* hit for either list style (ul or ol). We
             # match ul and ol separately to avoid adjacent lists of different
             # types running into each other (see issue #16).
-            hits = []
-            for marker_pat in (self._marker_ul, self._marker_ol):
-                less_than_tab = self.tab_width - 1
-                whole_list = r'''
-                    (                   # \1 = whole list
-                      (                 # \2
-                        [ ]{0,%d}
-                        (%s)            # \3 = first list item marker
-                        [ \t]+
-                        (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
-                      )
-                      (?:.+?)
-                      (                 # \4
-                          \Z
-                        |
-                          \n{2,}
-                          (?=\S)
-                          (?!           # Negative lookahead for another list item marker
-                            [ \t]*
-                            %s[ \t]+
-                          )
-                      )
-                    )
-                ''' % (less_than_tab, marker_pat, marker_pat)
-                if self.list_level:  # sub-list
-                    list_re = re.compile("^"+whole_list, re.X | re.M | re.S)
-                else:
-                    list_re = re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
-                                         re.X | re.M | re.S)
-                match = list_re.search(text, pos)
-                if match:
-                    hits.append((match.start(), match))
-            if not hits:
+            for i, list_re in enumerate(list_res):
+                if hits[i] is not None and hits[i].start() < pos:
+                    hits[i] = list_re.search(text, pos)
+            found = [m for m in hits if m is not None]
+            if not found:
                 break
-            hits.sort()
-            match = hits[0][1]
+            match = min(found, key=lambda m: m.start())
             start, end = match.span()
-            middle = self._list_sub(match)
-            text = text[:start] + middle + text[end:]
-            pos = start + len(middle) # start pos for next attempted match
+            chunks.append(text[pos:start])
+            chunks.append(self._list_sub(match))
+            pos = end # start pos for next attempted match
 
-        return text
+        if not chunks:
+            return text
+        chunks.append(text[pos:])
+        return ''.join(chunks)
 
     _list_item_re = re.compile(r'''
         (\n)?                   # leading line = \1
@@ -1537,36 +1574,19 @@ class Markdown(object):
         return list_str
 
     def _get_pygments_lexer(self, lexer_name):
-        try:
-            from pygments import lexers, util
-        except ImportError:
-            return None
-        try:
-            return lexers.get_lexer_by_name(lexer_name)
-        except util.ClassNotFound:
-            return None
+        return _pygments_lexer(lexer_name)
 
     def _color_with_pygments(self, codeblock, lexer, **formatter_opts):
-        import pygments
-        import pygments.formatters
-
-        class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
-            def _wrap_code(self, inner):
-                """A function for use in a Pygments Formatter which
-                wraps in <code> tags.
-                """
-                yield 0, "<code>"
-                for tup in inner:
-                    yield tup
-                yield 0, "</code>"
-
-            def wrap(self, source, outfile):
-                """Return the source with a code, pre, and div."""
-                return self._wrap_div(self._wrap_pre(self._wrap_code(source)))
-
         formatter_opts.setdefault("cssclass", "codehilite")
-        formatter = HtmlCodeFormatter(**formatter_opts)
-        return pygments.highlight(codeblock, lexer, formatter)
+        key = (lexer.__class__.__name__, repr(sorted(formatter_opts.items())),
+               md5(codeblock.encode("utf-8")).hexdigest())
+        colored = highlight_cache.get(key)
+        if colored is None:
+            import pygments
+            formatter = _html_code_formatter_class()(**formatter_opts)
+            colored = pygments.highlight(codeblock, lexer, formatter)
+            highlight_cache.put(key, colored)
+        return colored
 
     def _code_block_sub(self, match, is_fenced_code_block=False):
         lexer_name = None
@@ -1632,20 +1652,7 @@ class Markdown(object):
 
     def _do_code_blocks(self, text):
         """Process Markdown `<pre><code>` blocks."""
-        code_block_re = re.compile(r'''
-            (?:\n\n|\A\n?)
-            (               # $1 = the code block -- one or more lines, starting with a space/tab
-              (?:
-                (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
-                .*\n+
-              )+
-            )
-            ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
-            # Lookahead to make sure this block isn't already in a code block.
-            # Needed when syntax highlighting is being used.
-            (?![^<]*\</code\>)
-            ''' % (self.tab_width, self.tab_width),
-            re.M | re.X)
+        code_block_re = _code_block_re_from_tab_width(self.tab_width)
         return code_block_re.sub(self._code_block_sub, text)
 
     _fenced_code_block_re = re.compile(r'''
@@ -1733,14 +1740,21 @@ class Markdown(object):
     _em_re = re.compile(r"(\*|_)(?=\S)(.+?)(?<=\S)\1", re.S)
     _code_friendly_strong_re = re.compile(r"\*\*(?=\S)(.+?[*_]*)(?<=\S)\*\*", re.S)
     _code_friendly_em_re = re.compile(r"\*(?=\S)(.+?)(?<=\S)\*", re.S)
+    # Where a match of the above can start.
+    _strong_start_re = re.compile(r"\*\*|__")
+    _em_start_re = re.compile(r"[*_]")
     def _do_italics_and_bold(self, text):
         # <strong> must go first:
         if "code-friendly" in self.extras:
-            text = self._code_friendly_strong_re.sub(r"<strong>\1</strong>", text)
-            text = self._code_friendly_em_re.sub(r"<em>\1</em>", text)
+            text = self._sub_within_budget(self._code_friendly_strong_re,
+                r"<strong>\1</strong>", text, self._strong_start_re, "italics_and_bold")
+            text = self._sub_within_budget(self._code_friendly_em_re,
+                r"<em>\1</em>", text, self._em_start_re, "italics_and_bold")
         else:
-            text = self._strong_re.sub(r"<strong>\2</strong>", text)
-            text = self._em_re.sub(r"<em>\2</em>", text)
+            text = self._sub_within_budget(self._strong_re,
+                r"<strong>\2</strong>", text, self._strong_start_re, "italics_and_bold")
+            text = self._sub_within_budget(self._em_re,
+                r"<em>\2</em>", text, self._em_start_re, "italics_and_bold")
         return text
 
     # "smarty-pants" extra: Very liberal in interpreting a single prime as an
@@ -1829,6 +1843,7 @@ class Markdown(object):
         # Wrap <p> tags.
         grafs = []
         for i, graf in enumerate(re.split(r"\n{2,}", text)):
+            self._check_budget("paragraphs", i + 1)
             if graf in self.html_blocks:
                 # Unhashify HTML blocks
                 grafs.append(self.html_blocks[graf])
@@ -2203,25 +2218,55 @@ class _memoized(object):
    If called later with the same arguments, the cached value is returned, and
    not re-evaluated.
 
+   At most `maxsize` results are kept, the least recently used is dropped
+   first. Lookups are thread-safe; two threads missing the same arguments
+   at once may both call the function.
+
    http://wiki.python.org/moin/PythonDecoratorLibrary
    """
-   def __init__(self, func):
+   instances = []
+
+   def __init__(self, func, maxsize=128):
       self.func = func
-      self.cache = {}
+      self.maxsize = maxsize
+      self.cache = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+      self._lock = threading.Lock()
+      _memoized.instances.append(self)
    def __call__(self, *args):
       try:
-         return self.cache[args]
+         with self._lock:
+            value = self.cache[args]
+            self.cache.move_to_end(args)
+            self.hits += 1
+            return value
       except KeyError:
-         self.cache[args] = value = self.func(*args)
-         return value
+         pass
       except TypeError:
          # uncachable -- for instance, passing a list as an argument.
          # Better to not cache than to blow up entirely.
          return self.func(*args)
+      value = self.func(*args)
+      with self._lock:
+         self.misses += 1
+         self.cache[args] = value
+         if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+      return value
+   def stats(self):
+      calls = self.hits + self.misses
+      return dict(size=len(self.cache), maxsize=self.maxsize,
+                  hits=self.hits, misses=self.misses,
+                  hit_rate=float(self.hits) / calls if calls else 0.0)
    def __repr__(self):
       """Return the function's docstring."""
       return self.func.__doc__
 
+def memoized_stats():
+    """The cache stats of each memoized helper, by function name."""
+    return dict((m.func.__name__, m.stats()) for m in _memoized.instances)
+
 
 def _xml_oneliner_re_from_tab_width(tab_width):
     """Standalone XML processing instruction regex."""
@@ -2264,6 +2309,218 @@ def _hr_tag_re_from_tab_width(tab_width):
 _hr_tag_re_from_tab_width = _memoized(_hr_tag_re_from_tab_width)
 
 
+def _link_def_re_from_tab_width(tab_width):
+    """Link definition regex."""
+    return re.compile(r"""
+        ^[ ]{0,%d}\[(.+)\]: # id = \1
+          [ \t]*
+          \n?               # maybe *one* newline
+          [ \t]*
+        <?(.+?)>?           # url = \2
+          [ \t]*
+        (?:
+            \n?             # maybe one newline
+            [ \t]*
+            (?<=\s)         # lookbehind for whitespace
+            ['"(]
+            ([^\n]*)        # title = \3
+            ['")]
+            [ \t]*
+        )?  # title is optional
+        (?:\n+|\Z)
+        """ % (tab_width - 1), re.X | re.M | re.U)
+_link_def_re_from_tab_width = _memoized(_link_def_re_from_tab_width)
+
+def _footnote_def_re_from_tab_width(tab_width):
+    """Footnote definition regex."""
+    return re.compile(r'''
+        ^[ ]{0,%d}\[\^(.+)\]:   # id = \1
+        [ \t]*
+        (                       # footnote text = \2
+          # First line need not start with the spaces.
+          (?:\s*.*\n+)
+          (?:
+            (?:[ ]{%d} | \t)  # Subsequent lines must be indented.
+            .*\n+
+          )*
+        )
+        # Lookahead for non-space at line-start, or end of doc.
+        (?:(?=^[ ]{0,%d}\S)|\Z)
+        ''' % (tab_width - 1, tab_width, tab_width),
+        re.X | re.M)
+_footnote_def_re_from_tab_width = _memoized(_footnote_def_re_from_tab_width)
+
+def _table_re_from_tab_width(tab_width):
+    """PHP-Markdown/GFM table regex."""
+    less_than_tab = tab_width - 1
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)             # leading blank line
+
+        ^[ ]{0,%d}                      # allowed whitespace
+        (.*[|].*)  \n                   # $1: header row (at least one pipe)
+
+        ^[ ]{0,%d}                      # allowed whitespace
+        (                               # $2: underline row
+            # underline row with leading bar
+            (?:  \|\ *:?-+:?\ *  )+  \|?  \n
+            |
+            # or, underline row without leading bar
+            (?:  \ *:?-+:?\ *\|  )+  (?:  \ *:?-+:?\ *  )?  \n
+        )
+
+        (                               # $3: data rows
+            (?:
+                ^[ ]{0,%d}(?!\ )         # ensure line begins with 0 to less_than_tab spaces
+                .*\|.*  \n
+            )+
+        )
+    ''' % (less_than_tab, less_than_tab, less_than_tab), re.M | re.X)
+_table_re_from_tab_width = _memoized(_table_re_from_tab_width)
+
+def _wiki_table_re_from_tab_width(tab_width):
+    """Wiki table regex."""
+    return re.compile(r'''
+        (?:(?<=\n\n)|\A\n?)            # leading blank line
+        ^([ ]{0,%d})\|\|.+?\|\|[ ]*\n  # first line
+        (^\1\|\|.+?\|\|\n)*        # any number of subsequent lines
+        ''' % (tab_width - 1), re.M | re.X)
+_wiki_table_re_from_tab_width = _memoized(_wiki_table_re_from_tab_width)
+
+def _code_block_re_from_tab_width(tab_width):
+    """Indented code block regex."""
+    return re.compile(r'''
+        (?:\n\n|\A\n?)
+        (               # $1 = the code block -- one or more lines, starting with a space/tab
+          (?:
+            (?:[ ]{%d} | \t)  # Lines must start with a tab or a tab-width of spaces
+            .*\n+
+          )+
+        )
+        ((?=^[ ]{0,%d}\S)|\Z)   # Lookahead for non-space at line-start, or end of doc
+        # Lookahead to make sure this block isn't already in a code block.
+        # Needed when syntax highlighting is being used.
+        (?![^<]*\</code\>)
+        ''' % (tab_width, tab_width),
+        re.M | re.X)
+_code_block_re_from_tab_width = _memoized(_code_block_re_from_tab_width)
+
+def _list_res_from_tab_width(tab_width, sub_list):
+    """The (ul, ol) list regexes, anchored at line starts for sub-lists."""
+    res = []
+    for marker_pat in (Markdown._marker_ul, Markdown._marker_ol):
+        whole_list = r'''
+            (                   # \1 = whole list
+              (                 # \2
+                [ ]{0,%d}
+                (%s)            # \3 = first list item marker
+                [ \t]+
+                (?!\ *\3\ )     # '- - - ...' isn't a list. See 'not_quite_a_list' test case.
+              )
+              (?:.+?)
+              (                 # \4
+                  \Z
+                |
+                  \n{2,}
+                  (?=\S)
+                  (?!           # Negative lookahead for another list item marker
+                    [ \t]*
+                    %s[ \t]+
+                  )
+              )
+            )
+        ''' % (tab_width - 1, marker_pat, marker_pat)
+        if sub_list:
+            res.append(re.compile("^"+whole_list, re.X | re.M | re.S))
+        else:
+            res.append(re.compile(r"(?:(?<=\n\n)|\A\n?)"+whole_list,
+                                  re.X | re.M | re.S))
+    return tuple(res)
+_list_res_from_tab_width = _memoized(_list_res_from_tab_width)
+
+def _pygments_lexer(lexer_name):
+    """The Pygments lexer of this name, None if unknown or no Pygments."""
+    try:
+        from pygments import lexers, util
+    except ImportError:
+        return None
+    try:
+        return lexers.get_lexer_by_name(lexer_name)
+    except util.ClassNotFound:
+        return None
+_pygments_lexer = _memoized(_pygments_lexer, 64)
+
+def _html_code_formatter_class():
+    """The Pygments HtmlFormatter wrapping code in <code>, <pre> and <div>.
+    Pygments is only imported on the first highlighted code block.
+    """
+    import pygments.formatters
+
+    class HtmlCodeFormatter(pygments.formatters.HtmlFormatter):
+        def _wrap_code(self, inner):
+            """A function for use in a Pygments Formatter which
+            wraps in <code> tags.
+            """
+            yield 0, "<code>"
+            for tup in inner:
+                yield tup
+            yield 0, "</code>"
+
+        def wrap(self, source, outfile=None):
+            """Return the source with a code, pre, and div."""
+            source = self._wrap_pre(self._wrap_code(source))
+            if outfile is None:
+                # Pygments >= 2.12 adds the div itself.
+                return source
+            return self._wrap_div(source)
+
+    return HtmlCodeFormatter
+_html_code_formatter_class = _memoized(_html_code_formatter_class)
+
+
+class _HighlightCache(object):
+    """Highlighted HTML of code blocks shared by all conversions, keyed by
+    (lexer, formatter options, code hash). The least recently used entries
+    are dropped once the HTML held is over `max_bytes`; 0 disables it.
+    """
+    def __init__(self, max_bytes=8*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+    def put(self, key, html):
+        size = sys.getsizeof(html)
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= sys.getsizeof(old)
+            self._entries[key] = html
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                k, v = self._entries.popitem(last=False)
+                self.bytes -= sys.getsizeof(v)
+    def stats(self):
+        return dict(entries=len(self._entries), bytes=self.bytes,
+                    max_bytes=self.max_bytes, hits=self.hits, misses=self.misses)
+
+highlight_cache = _HighlightCache()
+
+# header ids come from the content, hence the bound
+_slugify = _memoized(_slugify, 1024)
+
+
 def _xml_escape_attr(attr, skip_single_quote=True):
     """Escape the given string for use in an HTML/XML tag attribute.
 
@@ -9,7 +9,9 @@ __author__ = 'Yihang Ding'
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, IntegerField, FloatField, TextField
+
+from config import configs
 
 def next_id():
 	return '%015d%s000' % (int(time.time())*1000, uuid.uuid4().hex)
@@ -25,6 +27,10 @@ class User(Model):
 	name = StringField(ddl = 'varchar(50)')
 	image = StringField(ddl = 'varchar(500)')
 	created_at = FloatField(default = time.time)
+	if configs.session.store_generations:
+		# bumped to revoke the signed session tokens of the user, needs:
+		# alter table users add column session_generation bigint not null default 0;
+		session_generation = IntegerField(default = 0)
 
 class Blog(Model):
 	__table__ = 'blogs'
@@ -37,6 +43,9 @@ class Blog(Model):
 	summary = StringField(ddl = 'varchar(200)')
 	content = TextField()
 	created_at = FloatField(default = time.time)
+	if configs.markdown.persist_html:
+		# needs: alter table blogs add column content_html mediumtext;
+		content_html = TextField()
 
 class Comment(Model):
 	__table__ = 'comments'
@@ -7,12 +7,31 @@ __author__ = 'Yihang Ding'
 orm frame
 '''
 
-import asyncio, logging
+import asyncio, logging, contextvars, contextlib, time, collections, weakref, os, uuid
 
 import aiomysql
 
+import cache
+
 def log(sql, args=()):
-	logging.info('SQL: %s' % sql)
+	# skip all logging work when INFO is off
+	if logging.root.isEnabledFor(logging.INFO):
+		logging.info('SQL: %s', sql)
+
+'''
+the statements are written with '?' placeholders, aiomysql wants '%s'.
+the translated statement is cached so that the replace() runs once per statement.
+'''
+
+_translated = {}
+
+def translate(sql):
+	s = _translated.get(sql)
+	if s is None:
+		if len(_translated) >= 1024:
+			_translated.clear()
+		s = _translated[sql] = sql.replace('?', '%s')
+	return s
 
 '''
 create the connection pool which commits automatically
@@ -20,8 +39,23 @@ create the connection pool which commits automatically
 
 async def create_pool(loop, **kw):
 	logging.info('create database coonnection pool...')
-	global __pool
-	__pool = await aiomysql.create_pool(
+	global __pool, _acquire_timeout
+	_acquire_timeout = kw.get('acquire_timeout', None)
+	__pool = await _create_pool(loop, kw, 'primary')
+	for i, replica_kw in enumerate(kw.get('replicas', None) or []):
+		# a replica inherits user, password, db... from the primary
+		replica_kw = dict(kw, **replica_kw)
+		logging.info('create replica connection pool %s: %s' % (i, replica_kw.get('host', 'localhost')))
+		name = '%s:%s' % (replica_kw.get('host', 'localhost'), replica_kw.get('port', 3306))
+		_replicas.append(Replica(await _create_pool(loop, replica_kw, name), name))
+	if _replicas:
+		asyncio.ensure_future(_check_replicas(kw.get('replica_check_interval', 5), kw.get('replica_max_lag', 5)))
+	if kw.get('adaptive', False):
+		asyncio.ensure_future(_adapt_pools(kw.get('minsize', 1), kw.get('adaptive_maxsize', 50), kw.get('adaptive_interval', 10)))
+
+async def _create_pool(loop, kw, name):
+	# aiomysql opens minsize connections before returning, so the pool starts warm
+	pool = await aiomysql.create_pool(
 		host = kw.get('host', 'localhost'),
 		port = kw.get('port', 3306),
 		user = kw['user'],
@@ -33,6 +67,225 @@ async def create_pool(loop, **kw):
 		minsize = kw.get('minsize', 1), 
 		loop = loop
 		)
+	_pool_stats[pool] = PoolStats(name, pool)
+	return pool
+
+'''
+pool instrumentation:
+every acquire is timed into a histogram, acquires waiting longer than
+acquire_timeout fail fast with asyncio.TimeoutError, and the age of
+the connections is tracked. pool_stats() returns all of it.
+'''
+
+_acquire_timeout = None
+_pool_stats = {}
+
+class PoolStats(object):
+
+	BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+	def __init__(self, name, pool):
+		self.name = name
+		self.pool = pool
+		self.acquires = 0
+		self.timeouts = 0
+		self.wait_total = 0.0
+		self.histogram = [0] * (len(self.BUCKETS) + 1)
+		self.recent = collections.deque(maxlen = 200)  # recent waits, for the adaptive mode
+		self.born = weakref.WeakKeyDictionary()  # connection => first seen
+
+	def observe(self, wait, conn):
+		self.acquires += 1
+		self.wait_total += wait
+		self.recent.append(wait)
+		for i, bound in enumerate(self.BUCKETS):
+			if wait <= bound:
+				self.histogram[i] += 1
+				break
+		else:
+			self.histogram[-1] += 1
+		self.born.setdefault(conn, time.time())
+
+	def recent_wait(self, percentile = 0.95):
+		if not self.recent:
+			return 0.0
+		L = sorted(self.recent)
+		return L[min(len(L) - 1, int(len(L) * percentile))]
+
+	def snapshot(self):
+		now = time.time()
+		ages = [now - t for c, t in self.born.items() if not c.closed]
+		histogram = dict(('<=%ss' % b, n) for b, n in zip(self.BUCKETS, self.histogram))
+		histogram['>%ss' % self.BUCKETS[-1]] = self.histogram[-1]
+		return dict(
+			name = self.name,
+			size = self.pool.size,
+			in_use = self.pool.size - self.pool.freesize,
+			idle = self.pool.freesize,
+			minsize = self.pool.minsize,
+			maxsize = self.pool.maxsize,
+			acquires = self.acquires,
+			timeouts = self.timeouts,
+			wait_avg = self.wait_total / self.acquires if self.acquires else 0.0,
+			wait_p95 = self.recent_wait(),
+			wait_histogram = histogram,
+			connection_age_max = max(ages) if ages else 0.0,
+			connection_age_avg = sum(ages) / len(ages) if ages else 0.0
+			)
+
+def pool_stats():
+	return [stats.snapshot() for stats in _pool_stats.values()]
+
+@contextlib.asynccontextmanager
+async def acquire(pool):
+	' acquire a connection from pool, timed and bounded by acquire_timeout. '
+	stats = _pool_stats[pool]
+	start = time.monotonic()
+	try:
+		if _acquire_timeout:
+			conn = await asyncio.wait_for(pool.acquire(), _acquire_timeout)
+		else:
+			conn = await pool.acquire()
+	except asyncio.TimeoutError:
+		stats.timeouts += 1
+		logging.warning('acquire from pool %s timed out after %ss' % (stats.name, _acquire_timeout))
+		raise
+	stats.observe(time.monotonic() - start, conn)
+	try:
+		yield conn
+	finally:
+		pool.release(conn)
+
+'''
+adaptive pool size: grow maxsize while acquires queue up, shrink it
+(closing idle connections) while they don't. aiomysql keeps maxsize as
+the maxlen of its free deque, which is rebuilt here; the pool size never
+exceeds the new maxsize so that release() cannot drop a connection.
+'''
+
+def resize_pool(pool, maxsize):
+	free = pool._free
+	while free and pool.size > maxsize:
+		free.pop().close()
+	pool._free = collections.deque(free, maxlen = max(maxsize, pool.size))
+
+async def _adapt_pools(minsize, maxsize, interval, grow_wait = 0.01, shrink_wait = 0.001):
+	while True:
+		await asyncio.sleep(interval)
+		for pool, stats in _pool_stats.items():
+			wait = stats.recent_wait()
+			if wait > grow_wait and pool.maxsize < maxsize:
+				target = min(maxsize, pool.maxsize * 2)
+			elif wait < shrink_wait and pool.freesize > 0 and pool.maxsize > minsize:
+				target = max(minsize, pool.maxsize - 1)
+			else:
+				continue
+			logging.info('resize pool %s: %s => %s (p95 wait: %.4fs)' % (stats.name, pool.maxsize, target, wait))
+			resize_pool(pool, target)
+			stats.recent.clear()
+
+'''
+read replicas:
+reads go to the healthy replica with the fewest outstanding queries.
+once the current request has written something, its reads stay on
+the primary so that it always sees its own writes.
+'''
+
+class Replica(object):
+
+	def __init__(self, pool, name):
+		self.pool = pool
+		self.name = name
+		self.outstanding = 0
+		self.healthy = True
+		self.lag = None
+		self.status_sql = 'SHOW REPLICA STATUS'
+
+_replicas = []
+
+# True once the current request has written to the primary
+_wrote = contextvars.ContextVar('wrote', default = False)
+
+def mark_written():
+	if _replicas:
+		_wrote.set(True)
+
+@contextlib.contextmanager
+def read_primary():
+	' reads inside this block go to the primary, for data that must not lag. '
+	token = _wrote.set(True)
+	try:
+		yield
+	finally:
+		_wrote.reset(token)
+
+def pick_replica():
+	if not _replicas or _wrote.get():
+		return None
+	healthy = [r for r in _replicas if r.healthy]
+	if not healthy:
+		return None
+	return min(healthy, key = lambda r: r.outstanding)
+
+@contextlib.asynccontextmanager
+async def read_connection():
+	' acquire a connection for reading, from a replica if possible. '
+	tx = _transaction.get()
+	if tx is not None:
+		yield tx.conn
+		return
+	replica = pick_replica()
+	if replica is None:
+		async with acquire(__pool) as conn:
+			yield conn
+		return
+	replica.outstanding += 1
+	try:
+		async with acquire(replica.pool) as conn:
+			yield conn
+	finally:
+		replica.outstanding -= 1
+
+async def _replica_lag(r):
+	' seconds the replica is behind its source, 0 when it is not replicating. '
+	async with acquire(r.pool) as conn:
+		try:
+			async with conn.cursor(aiomysql.DictCursor) as cur:
+				try:
+					await cur.execute(r.status_sql)
+				except aiomysql.ProgrammingError:
+					# SHOW REPLICA STATUS needs MySQL 8.0.22, SHOW SLAVE STATUS is gone in 8.4
+					r.status_sql = 'SHOW SLAVE STATUS' if r.status_sql == 'SHOW REPLICA STATUS' else 'SHOW REPLICA STATUS'
+					await cur.execute(r.status_sql)
+				status = await cur.fetchone()
+		except asyncio.CancelledError:
+			# the reply is still pending, so the connection cannot be reused
+			conn.close()
+			raise
+	if not status:
+		return 0
+	if 'Seconds_Behind_Source' in status:
+		return status['Seconds_Behind_Source']
+	return status.get('Seconds_Behind_Master')
+
+async def _check_replicas(interval, max_lag):
+	' evict replicas lagging more than max_lag seconds or not answering within interval, take them back once they catch up. '
+	while True:
+		for r in _replicas:
+			try:
+				r.lag = await asyncio.wait_for(_replica_lag(r), interval)
+				healthy = r.lag is not None and r.lag <= max_lag
+			except asyncio.TimeoutError:
+				logging.warning('replica %s check timed out after %ss' % (r.name, interval))
+				r.lag = None
+				healthy = False
+			except Exception as e:
+				logging.warning('replica %s check failed: %s' % (r.name, e))
+				healthy = False
+			if healthy != r.healthy:
+				logging.warning('replica %s is %s (lag: %s)' % (r.name, 'back' if healthy else 'evicted', r.lag))
+			r.healthy = healthy
+		await asyncio.sleep(interval)
 
 '''
 execute SELECT by function select()
@@ -40,18 +293,111 @@ execute SELECT by function select()
 
 async def select(sql, args, size = None):
 	log(sql, args)
-	global __pool
-	with (await __pool) as conn:
+	async with read_connection() as conn:
 		cur = await conn.cursor(aiomysql.DictCursor)
-		await cur.execute(sql.replace('?', '%s'), args or ())
+		await cur.execute(translate(sql), args or ())
 		if size: # if size is assined rather than None
 			rs = await cur.fetchmany(size)
 		else:
 			rs = await cur.fetchall()
 		await cur.close()
-		logging.info('rows returned: %s' % len(rs))
+		logging.info('rows returned: %s', len(rs))
 		return rs
 
+'''
+execute SELECT with a plain tuple cursor, return (column names, rows)
+'''
+
+async def select_tuples(sql, args, size = None):
+	log(sql, args)
+	async with read_connection() as conn:
+		cur = await conn.cursor()
+		await cur.execute(translate(sql), args or ())
+		if size:
+			rs = await cur.fetchmany(size)
+		else:
+			rs = await cur.fetchall()
+		names = [d[0] for d in cur.description]
+		await cur.close()
+		logging.info('rows returned: %s', len(rs))
+		return names, rs
+
+'''
+stream the result of SELECT with a server side cursor:
+an async generator yielding lists of at most batch_size rows.
+the connection is held until the generator is exhausted or closed.
+'''
+
+async def iterate_select(sql, args, batch_size = 100):
+	log(sql, args)
+	async with read_connection() as conn:
+		cur = await conn.cursor(aiomysql.SSDictCursor)
+		try:
+			await cur.execute(translate(sql), args or ())
+			while True:
+				rs = await cur.fetchmany(batch_size)
+				if not rs:
+					break
+				yield rs
+		finally:
+			await cur.close()
+
+'''
+transactions spanning several statements:
+
+	async with orm.transaction():
+		await blog.remove()
+		await Comment.removeWhere('`blog_id`=?', [blog.id])
+
+every orm call inside the block runs on the one connection pinned by the
+transaction (found through a contextvar), and the whole block is committed
+or rolled back once. Nested transaction() blocks join the outer one.
+Statements inside a transaction must not run concurrently (no gather()).
+'''
+
+_transaction = contextvars.ContextVar('transaction', default = None)
+
+class Transaction(object):
+
+	def __init__(self, conn):
+		self.conn = conn
+		self.count_deltas = {}  # table => rows added, applied to the count cache on commit
+		self.changed = set()  # tables written, their query cache is invalidated again at the end
+
+@contextlib.asynccontextmanager
+async def transaction():
+	tx = _transaction.get()
+	if tx is not None:
+		yield tx
+		return
+	mark_written()
+	async with acquire(__pool) as conn:
+		await conn.begin()
+		tx = Transaction(conn)
+		token = _transaction.set(tx)
+		try:
+			yield tx
+			await conn.commit()
+		except BaseException as e:
+			await conn.rollback()
+			raise
+		finally:
+			_transaction.reset(token)
+			for table in tx.changed:
+				bump_version(table)
+	for table, delta in tx.count_deltas.items():
+		_adjust_count(table, delta)
+
+@contextlib.asynccontextmanager
+async def write_connection():
+	' the connection of the current transaction, or a fresh one from the primary. '
+	tx = _transaction.get()
+	if tx is not None:
+		yield tx.conn
+		return
+	async with acquire(__pool) as conn:
+		yield conn
+
 '''
 to execute INSERT, UPDATE and DELETE
 we can define a general function named execute
@@ -59,12 +405,15 @@ we can define a general function named execute
 
 async def execute(sql, args, autocommit = True):
 	log(sql)
-	with (await  __pool) as conn:
+	mark_written()
+	# inside transaction() the statement is committed with the transaction
+	autocommit = autocommit or _transaction.get() is not None
+	async with write_connection() as conn:
 		if not autocommit:
 			await conn.begin()
 		try:
 			async with conn.cursor(aiomysql.DictCursor) as cur:
-				await cur.execute(sql.replace('?', '%s'), args)
+				await cur.execute(translate(sql), args)
 				affected = cur.rowcount
 			if not autocommit:
 				await conn.commit()
@@ -74,12 +423,321 @@ async def execute(sql, args, autocommit = True):
 			raise
 		return affected
 
+'''
+coalesce Model.find(pk) calls:
+every find() made in the same event loop iteration is parked on a future,
+and once the loop gets to the callback scheduled below, one
+'select ... where pk in (...)' is issued per model and the futures are resolved.
+'''
+
+_pending_loads = {}
+_dispatch_scheduled = False
+
+# the per-request identity map: {(table, pk): row or None}
+_identity_map = contextvars.ContextVar('identity_map', default = None)
+
+def begin_request():
+	'''
+	start a fresh identity map and replica stickiness for the current
+	request, return the tokens for end_request().
+	'''
+	return _identity_map.set({}), _wrote.set(False)
+
+def end_request(tokens):
+	_identity_map.reset(tokens[0])
+	_wrote.reset(tokens[1])
+
+def invalidate(cls, *pks):
+	'''
+	called after rows of cls have been written: drop the rows from the
+	identity map (without pks, every row of the table, for bulk writes)
+	and invalidate the cached query results of the table, once.
+	'''
+	bump_version(cls.__table__)
+	tx = _transaction.get()
+	if tx is not None:
+		# other requests may read the old rows until commit, bump again then
+		tx.changed.add(cls.__table__)
+	identity = _identity_map.get()
+	if identity is None:
+		return
+	if pks:
+		for pk in pks:
+			identity.pop((cls.__table__, pk), None)
+	else:
+		for key in [k for k in identity if k[0] == cls.__table__]:
+			del identity[key]
+
+def _dispatch_loads():
+	global _pending_loads, _dispatch_scheduled
+	pending = _pending_loads
+	_pending_loads = {}
+	_dispatch_scheduled = False
+	for (cls, primary), waiters in pending.items():
+		asyncio.ensure_future(_load_batch(cls, primary, waiters))
+
+async def _load_batch(cls, primary, waiters):
+	_wrote.set(primary)
+	try:
+		rows = await cls.findByIds(list(waiters.keys()))
+	except BaseException as e:
+		for futures in waiters.values():
+			for f in futures:
+				if not f.done():
+					f.set_exception(e)
+		return
+	for pk, futures in waiters.items():
+		r = rows.get(pk)
+		for f in futures:
+			if not f.done():
+				f.set_result(r)
+
+async def load(cls, pk):
+	'''
+	load one row by primary key through the batching loader.
+	every caller gets its own instance, so handlers may modify
+	the result (e.g. mask passwd) without affecting each other.
+	'''
+	global _dispatch_scheduled
+	identity = _identity_map.get()
+	key = (cls.__table__, pk)
+	if identity is not None and key in identity:
+		r = identity[key]
+		return None if r is None else cls(**r)
+	if _transaction.get() is not None:
+		# the pinned connection must not be shared with the batch of other requests
+		r = (await cls.findByIds([pk])).get(pk)
+		if identity is not None:
+			identity[key] = None if r is None else dict(r)
+		return r
+	loop = asyncio.get_event_loop()
+	fut = loop.create_future()
+	_pending_loads.setdefault((cls, _wrote.get()), {}).setdefault(pk, []).append(fut)
+	if not _dispatch_scheduled:
+		_dispatch_scheduled = True
+		loop.call_soon(_dispatch_loads)
+	r = await fut
+	if identity is not None:
+		identity[key] = None if r is None else dict(r)
+	return None if r is None else cls(**r)
+
+'''
+opt-in cache of query results, findAll(..., cache=True):
+results are keyed by the SQL and args, and tagged with the version of
+the table they were read from. Every write bumps the version of its
+table, so a cached result is only used while its table is unchanged.
+Results are read from the primary, a lagging replica would cache old rows
+under the new version. Writes by processes which do not share the cache
+are not seen, so results are also dropped after ttl seconds. Least
+recently used results are evicted beyond max_entries / max_bytes.
+'''
+
+_table_versions = {}
+
+def bump_version(table):
+	_table_versions[table] = _table_versions.get(table, 0) + 1
+	if not _unpublished:
+		asyncio.get_event_loop().call_soon(_flush_invalidations)
+	_unpublished.add(table)
+
+'''
+cross-process invalidation: the tables bumped during one loop iteration
+are published together on the shared cache (see cache.py), and the other
+processes bump the version of the tables too and drop their cached counts.
+'''
+
+_unpublished = set()
+
+def _flush_invalidations():
+	tables = sorted(_unpublished)
+	_unpublished.clear()
+	asyncio.ensure_future(_publish_invalidation(tables))
+
+INVALIDATE_CHANNEL = 'orm:invalidate'
+
+_origin = '%s-%s' % (os.getpid(), uuid.uuid4().hex)
+
+async def subscribe_invalidations():
+	await cache.get_cache().subscribe(INVALIDATE_CHANNEL, _on_invalidate)
+
+async def _publish_invalidation(tables):
+	try:
+		await cache.get_cache().publish(INVALIDATE_CHANNEL, dict(origin = _origin, tables = tables))
+	except Exception as e:
+		logging.warning('failed to publish invalidation of %s: %s' % (', '.join(tables), e))
+
+def _on_invalidate(message):
+	if message.get('origin') == _origin:
+		return
+	for table in message['tables']:
+		_table_versions[table] = _table_versions.get(table, 0) + 1
+		for key in [k for k in _count_cache if k[0] == table]:
+			del _count_cache[key]
+
+def _size_of(rs):
+	' a rough size in bytes of a list of rows. '
+	n = 64
+	for r in rs:
+		for v in (r.values() if isinstance(r, dict) else r):
+			n += len(v) if isinstance(v, str) else 16
+	return n
+
+class QueryCache(object):
+
+	def __init__(self, max_entries = 1024, max_bytes = 16 * 1024 * 1024, ttl = 30):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.entries = collections.OrderedDict()  # key => (table, version, size, result, expires)
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, table, key):
+		entry = self.entries.get(key)
+		if entry is not None:
+			if entry[1] == _table_versions.get(table, 0) and entry[4] > time.time():
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry[3]
+			self._drop(key)
+		self.misses += 1
+		return None
+
+	def put(self, table, key, version, result, size):
+		if size > self.max_bytes:
+			return
+		if key in self.entries:
+			self._drop(key)
+		self.entries[key] = (table, version, size, result, time.time() + self.ttl)
+		self.bytes += size
+		while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+			self._drop(next(iter(self.entries)))
+			self.evictions += 1
+
+	def _drop(self, key):
+		self.bytes -= self.entries.pop(key)[2]
+
+	def stats(self):
+		total = self.hits + self.misses
+		return dict(entries = len(self.entries), bytes = self.bytes, hits = self.hits, misses = self.misses,
+			evictions = self.evictions, hit_rate = self.hits / total if total else 0.0)
+
+_query_cache = QueryCache()
+
+def configure_query_cache(max_entries = 1024, max_bytes = 16 * 1024 * 1024, ttl = 30):
+	global _query_cache
+	_query_cache = QueryCache(max_entries, max_bytes, ttl)
+
+def query_cache_stats():
+	return _query_cache.stats()
+
+async def cached_select(table, sql, args, tuples = False):
+	' select() or select_tuples() through the query cache. '
+	key = (sql, tuple(args), tuples)
+	result = _query_cache.get(table, key)
+	if result is not None:
+		return result
+	# take the version before reading, a write racing with the read makes the entry stale
+	version = _table_versions.get(table, 0)
+	with read_primary():
+		if tuples:
+			result = await select_tuples(sql, args)
+			size = _size_of(result[1])
+		else:
+			result = await select(sql, args)
+			size = _size_of(result)
+	_query_cache.put(table, key, version, result, size)
+	return result
+
+'''
+cache the result of unfiltered row counts, findNumber('count(*)') or
+findNumber('count(<primary key>)'); other expressions such as
+count(distinct ...) or counts of nullable columns are not cached.
+The cached number is kept exact by save/remove and the bulk writes, and
+dropped after ttl seconds in case rows are written by another process.
+When estimate_threshold is set, tables whose InnoDB estimate in
+information_schema exceeds it are not counted but estimated.
+'''
+
+_count_cache = {}
+_count_ttl = 60
+_count_estimate_threshold = 0
+
+def configure_count_cache(ttl = 60, estimate_threshold = 0):
+	global _count_ttl, _count_estimate_threshold
+	_count_ttl = ttl
+	_count_estimate_threshold = estimate_threshold
+	_count_cache.clear()
+
+def adjust_count(cls, delta):
+	' add delta to every cached count of the table of cls, once the current transaction commits. '
+	tx = _transaction.get()
+	if tx is not None:
+		tx.count_deltas[cls.__table__] = tx.count_deltas.get(cls.__table__, 0) + delta
+	else:
+		_adjust_count(cls.__table__, delta)
+
+def _adjust_count(table, delta):
+	for key, entry in _count_cache.items():
+		if key[0] == table:
+			entry[0] += delta
+
+def _counts_rows(cls, selectField):
+	' True if selectField counts every row, so inserts and deletes move it by one. '
+	field = selectField.replace('`', '').replace(' ', '').lower()
+	return field in ('count(*)', 'count(%s)' % cls.__primary_key__.lower())
+
+async def _count(cls, selectField):
+	key = (cls.__table__, selectField)
+	entry = _count_cache.get(key)
+	if entry is not None and entry[1] > time.time():
+		return entry[0]
+	num = None
+	if _count_estimate_threshold:
+		rs = await select('select table_rows _num_ from information_schema.tables where table_schema=database() and table_name=?', [cls.__table__], 1)
+		if rs and rs[0]['_num_'] is not None and rs[0]['_num_'] >= _count_estimate_threshold:
+			num = rs[0]['_num_']
+	if num is None:
+		rs = await select('select %s _num_ from `%s`' % (selectField, cls.__table__), None, 1)
+		if len(rs) == 0:
+			return None
+		num = rs[0]['_num_']
+	if _count_ttl:
+		_count_cache[key] = [num, time.time() + _count_ttl]
+	return num
+
+'''
+run several INSERT, UPDATE or DELETE statements on one connection
+inside a single transaction, return the affected rows of every statement
+'''
+
+async def execute_batch(statements):
+	affected = []
+	async with transaction() as tx:
+		async with tx.conn.cursor(aiomysql.DictCursor) as cur:
+			for sql, args in statements:
+				log(sql)
+				await cur.execute(translate(sql), args)
+				affected.append(cur.rowcount)
+	return affected
+
 def create_args_string(num):
     L = []
     for n in range(num):
         L.append('?')
     return ', '.join(L)
 
+class Expr(object):
+	'''
+	a raw SQL expression used as a value in Model.updateWhere(), e.g.
+	Expr('CONCAT(`user_name`, ?)', ' (deleted)')
+	'''
+	def __init__(self, sql, *args):
+		self.sql = sql
+		self.args = list(args)
+
 class Field():
 
 	def __init__(self, name, column_type, primary_key, default):
@@ -117,6 +775,53 @@ class TextField(Field):
 		super().__init__(name, 'text', False, default)
 		
 		
+class Row(object):
+	'''
+	compact read-only row returned by findAll(..., rows=True).
+	ModelMetaclass generates one subclass per model with the columns
+	in __slots__, so a row costs no per-row dict. Attributes and
+	row['key'] both work, and asdict() gives what json needs.
+	'''
+	__slots__ = ()
+
+	def __init__(self, names, values):
+		for k, v in zip(names, values):
+			object.__setattr__(self, k, v)
+
+	def __setattr__(self, key, value):
+		raise AttributeError('%s is read-only' % self.__class__.__name__)
+
+	def __getitem__(self, key):
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+
+	def get(self, key, default = None):
+		return getattr(self, key, default)
+
+	def asdict(self):
+		d = dict()
+		for k in self.__slots__:
+			try:
+				d[k] = getattr(self, k)
+			except AttributeError:
+				pass  # not selected
+		return d
+
+	@classmethod
+	def fromTuples(cls, names, rs):
+		# write the slots through their descriptors, skipping __init__ and __setattr__
+		setters = [getattr(cls, k).__set__ for k in names]
+		new = object.__new__
+		L = []
+		for values in rs:
+			r = new(cls)
+			for setter, v in zip(setters, values):
+				setter(r, v)
+			L.append(r)
+		return L
+
 class ModelMetaclass(type):
 
 	def __new__(cls, name, bases, attrs):
@@ -163,10 +868,15 @@ class ModelMetaclass(type):
 		attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
 		attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
 		attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+		attrs['__queries__'] = dict()
+		attrs['__row__'] = type('%sRow' % name, (Row,), dict(__slots__ = tuple([primaryKey] + fields)))
 		return type.__new__(cls, name, bases, attrs)
 
 class Model(dict, metaclass = ModelMetaclass):
 
+	# names of fields left out by findAll(columns=..., defer=...), see loadDeferred()
+	__deferred__ = frozenset()
+
 	def __init__(self, **kw):
 		super().__init__(**kw)
 
@@ -174,6 +884,8 @@ class Model(dict, metaclass = ModelMetaclass):
 		try:
 			return self[key]
 		except KeyError:
+			if key in self.__deferred__:
+				raise AttributeError(r"'Model' field %s is deferred, call loadDeferred() first" % key)
 			raise AttributeError(r"'Model' object has no attribute: %s" % key)
 
 	def setattr(self, key, value):
@@ -198,25 +910,65 @@ class Model(dict, metaclass = ModelMetaclass):
 		return value
 
 	@classmethod
-	async def findAll(cls, where = None, args = None, **kw):
-		
-		''' 
-		please note that the first variable 'cls' means this
-		function can be directly called by 'class', such as
-		Model.findAll(...). It is in fact the same with 'self' 
-		in terms of their effects.
+	def projection(cls, columns = None, defer = None):
 		'''
+		return (select string, deferred field names) for loading only
+		the given columns (or all but the deferred ones). The primary key
+		is always selected.
+		'''
+		if not columns and not defer:
+			return cls.__select__, frozenset()
+		fields = [f for f in cls.__fields__ if (not columns or f in columns) and (not defer or f not in defer)]
+		deferred = frozenset(cls.__fields__) - frozenset(fields)
+		sql = 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, [cls.__primary_key__] + fields)), cls.__table__)
+		return sql, deferred
 
-		'  find objects by where clause. '
+	@classmethod
+	def fromRows(cls, rs, deferred = frozenset()):
+		L = [cls(**r) for r in rs]
+		if deferred:
+			for r in L:
+				r.__deferred__ = deferred
+		return L
 
-		sql = [cls.__select__]
+	@classmethod
+	async def loadDeferred(cls, instances, chunk_size = 500):
+		'''
+		fetch the deferred fields of instances loaded with columns/defer,
+		one 'where pk in (...)' query per chunk for all of them.
+		'''
+		pending = dict((r[cls.__primary_key__], r) for r in instances if r.__deferred__)
+		if not pending:
+			return instances
+		fields = [f for f in cls.__fields__ if any(f in r.__deferred__ for r in pending.values())]
+		keys = list(pending.keys())
+		for i in range(0, len(keys), chunk_size):
+			chunk = keys[i:i + chunk_size]
+			sql = 'select %s from `%s` where `%s` in (%s)' % (', '.join(map(lambda f: '`%s`' % f, [cls.__primary_key__] + fields)), cls.__table__, cls.__primary_key__, create_args_string(len(chunk)))
+			for row in await select(sql, chunk):
+				r = pending[row[cls.__primary_key__]]
+				for f in fields:
+					if f in r.__deferred__:
+						r[f] = row[f]
+				r.__deferred__ = frozenset()
+		return instances
+
+	@classmethod
+	def compileSelect(cls, where = None, **kw):
+		' build (sql, deferred fields) for findAll(); the args are added by buildSelect(). '
+		selectSql, deferred = cls.projection(kw.get('columns', None), kw.get('defer', None))
+		sql = [selectSql]
+		if kw.get('seek', None) is not None:
+			# keyset pagination: continue after the row (seek_value, pk) of the previous page,
+			# orderBy must be '<seekField> desc, <primary key> desc' to match.
+			seekField = kw.get('seekField', 'created_at')
+			clause = '(`%s`<? or (`%s`=? and `%s`<?))' % (seekField, seekField, cls.__primary_key__)
+			where = '(%s) and %s' % (where, clause) if where else clause
 		if where:
 			sql.append('where')
 			sql.append(where)
 			# if 'where' is assigned, now sql(list) has three elements:
 			# select string, 'where', and value of where
-		if args is None:
-			args = []
 		orderBy = kw.get('orderBy', None)
 		# default value
 		# whether it would be ordered or not depends on input: kw
@@ -229,21 +981,117 @@ class Model(dict, metaclass = ModelMetaclass):
 			sql.append('limit')
 			if isinstance(limit, int):
 				sql.append('?')
-				args.append(limit)
 			elif isinstance(limit, tuple) and len(limit) == 2:
 				sql.append('?, ?')
+			else:
+				raise ValueError('Invalid limit value: %s' % str(limit))
+		return ' '.join(sql), deferred
+
+	@classmethod
+	def buildSelect(cls, where = None, args = None, orderBy = None, limit = None, columns = None, defer = None, seek = None, seekField = 'created_at', **kw):
+		'''
+		build (sql, args, deferred fields) for findAll() and iterate().
+		the sql only depends on the shape of the query, so it is
+		compiled once per shape and cached in __queries__.
+		'''
+		key = (where, orderBy, len(limit) if limit.__class__ is tuple else limit.__class__,
+			tuple(columns) if columns else None, tuple(defer) if defer else None, seek is not None, seekField)
+		compiled = cls.__queries__.get(key)
+		if compiled is None:
+			compiled = cls.compileSelect(where, orderBy = orderBy, limit = limit, columns = columns, defer = defer, seek = seek, seekField = seekField)
+			if len(cls.__queries__) >= 256:
+				cls.__queries__.clear()
+			cls.__queries__[key] = compiled
+		sql, deferred = compiled
+		args = list(args) if args else []
+		if seek is not None:
+			value, pk = seek
+			args.extend([value, value, pk])
+		if limit is not None:
+			if isinstance(limit, int):
+				args.append(limit)
+			else:
 				args.extend(limit)
 				# not like 'append', 'extend' would add all elements from limit in 'args'
 				# while 'append' would add 'limit' as a whole in 'args'
+		return sql, args, deferred
+
+	@classmethod
+	async def findAll(cls, where = None, args = None, **kw):
+		
+		''' 
+		please note that the first variable 'cls' means this
+		function can be directly called by 'class', such as
+		Model.findAll(...). It is in fact the same with 'self' 
+		in terms of their effects.
+		'''
+
+		'  find objects by where clause. '
+		'  with rows=True, return read-only Row objects instead of models. '
+		'  with cache=True, the result may come from the query cache. '
+
+		sql, args, deferred = cls.buildSelect(where, args, **kw)
+		cache = kw.get('cache', False) and _transaction.get() is None
+		if kw.get('rows', False):
+			if cache:
+				names, rs = await cached_select(cls.__table__, sql, args, True)
 			else:
-				raise ValueError('Invalid limit value: %s' % str(limit))
-		rs = await select(' '.join(sql), args)
-		return [cls(**r) for r in rs]
+				names, rs = await select_tuples(sql, args)
+			return cls.__row__.fromTuples(names, rs)
+		if cache:
+			rs = await cached_select(cls.__table__, sql, args)
+		else:
+			rs = await select(sql, args)
+		# fromRows() copies the cached dicts, so handlers may modify the models
+		return cls.fromRows(rs, deferred)
 		# seemingly the output is rs itself as a list.
 
+	@classmethod
+	async def iterate(cls, where = None, args = None, batch_size = 100, **kw):
+		'''
+		like findAll(), but an async iterator which streams the rows from
+		a server side cursor batch_size rows at a time, so that the whole
+		result never has to be held in memory:
+
+			async for blog in Blog.iterate(orderBy='created_at'):
+				...
+		'''
+		sql, args, deferred = cls.buildSelect(where, args, **kw)
+		async for rs in iterate_select(sql, args, batch_size):
+			for r in cls.fromRows(rs, deferred):
+				yield r
+
+	@classmethod
+	async def findAllIn(cls, field, values, chunk_size = 500, **kw):
+		'''
+		find objects whose `field` is one of `values` by issuing
+		'select ... where `field` in (?, ?, ...)' statements.
+		Large value sets are split into chunks of chunk_size so that
+		the number of queries does not depend on len(values) row by row.
+		columns/defer work as in findAll().
+		'''
+		values = list(dict.fromkeys(v for v in values if v is not None))
+		# drop duplicates and None but keep the original order
+		selectSql, deferred = cls.projection(kw.get('columns', None), kw.get('defer', None))
+		results = []
+		for i in range(0, len(values), chunk_size):
+			chunk = values[i:i + chunk_size]
+			sql = '%s where `%s` in (%s)' % (selectSql, field, create_args_string(len(chunk)))
+			rs = await select(sql, chunk)
+			results.extend(cls.fromRows(rs, deferred))
+		return results
+
+	@classmethod
+	async def findByIds(cls, ids, chunk_size = 500, **kw):
+		' find objects by a collection of primary keys, return a dict keyed by primary key. '
+		rs = await cls.findAllIn(cls.__primary_key__, ids, chunk_size, **kw)
+		return dict((r[cls.__primary_key__], r) for r in rs)
+
 	@classmethod
 	async def findNumber(cls, selectField, where = None, args = None):
 		' find number by select and where. '
+		if not where and _counts_rows(cls, selectField):
+			return await _count(cls, selectField)
 		sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
 		if where:
 			sql.append('where')
@@ -255,30 +1103,109 @@ class Model(dict, metaclass = ModelMetaclass):
 
 	@classmethod
 	async def find(cls, pk):
-		' find object by primary key. '
-		rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
-		if len(rs) == 0:
-			return None
-		logging.info('~~~~~~~~~', rs[0])
-		return cls(**rs[0])
+		' find object by primary key, batched with other find() calls of the same loop iteration. '
+		return await load(cls, pk)
 
 	async def save(self):
 		args = list(map(self.getValueOrDefault, self.__fields__))
 		args.append(self.getValueOrDefault(self.__primary_key__))
 		rows = await execute(self.__insert__, args)
+		invalidate(self.__class__, args[-1])
+		adjust_count(self.__class__, rows)
 		if rows != 1:
 			logging.warn('failed to insert record: affected rows: %s' % rows)
 
+	@classmethod
+	async def saveMany(cls, instances, batch_size = 500):
+		'''
+		insert instances with multi-row 'insert ... values (...), (...)'
+		statements, batch_size rows per statement, all on one connection
+		inside a single transaction. Missing values are filled with the
+		defaults of __mapping__ just like save() does.
+		return a list with the affected rows of each batch.
+		'''
+		rows = []
+		for instance in instances:
+			args = list(map(instance.getValueOrDefault, cls.__fields__))
+			args.append(instance.getValueOrDefault(cls.__primary_key__))
+			rows.append(args)
+		if not rows:
+			return []
+		head = 'insert into `%s` (%s, `%s`) values ' % (cls.__table__, ', '.join(map(lambda f: '`%s`' % f, cls.__fields__)), cls.__primary_key__)
+		values = '(%s)' % create_args_string(len(cls.__fields__) + 1)
+		statements = []
+		for i in range(0, len(rows), batch_size):
+			batch = rows[i:i + batch_size]
+			statements.append((head + ', '.join([values] * len(batch)), [a for r in batch for a in r]))
+		affected = await execute_batch(statements)
+		for i, n in enumerate(affected):
+			expected = min(batch_size, len(rows) - i * batch_size)
+			if n != expected:
+				logging.warn('failed to insert batch %s: affected rows: %s of %s' % (i, n, expected))
+		invalidate(cls, *[args[-1] for args in rows])
+		adjust_count(cls, sum(affected))
+		return affected
+
+	@classmethod
+	async def updateWhere(cls, set_fields, where, args = None):
+		'''
+		update every row matching the where clause with one statement.
+		set_fields maps field names to new values; an Expr value is
+		inserted as SQL so that columns can be updated from themselves.
+		return the number of affected rows. where is required, pass '1=1'
+		to update the whole table.
+		'''
+		if not set_fields:
+			raise ValueError('Nothing to update.')
+		if not where:
+			raise ValueError('Missing where clause.')
+		assignments = []
+		set_args = []
+		for k, v in set_fields.items():
+			if k not in cls.__mapping__:
+				raise ValueError('Invalid field: %s' % k)
+			if isinstance(v, Expr):
+				assignments.append('`%s`=%s' % (k, v.sql))
+				set_args.extend(v.args)
+			else:
+				assignments.append('`%s`=?' % k)
+				set_args.append(v)
+		sql = 'update `%s` set %s where %s' % (cls.__table__, ', '.join(assignments), where)
+		rows = await execute(sql, set_args + list(args or []), autocommit = False)
+		invalidate(cls)
+		return rows
+
+	@classmethod
+	async def removeWhere(cls, where, args = None):
+		' delete every row matching the where clause with one statement, return the number of affected rows. '
+		if not where:
+			raise ValueError('Missing where clause.')
+		sql = 'delete from `%s` where %s' % (cls.__table__, where)
+		rows = await execute(sql, list(args or []), autocommit = False)
+		invalidate(cls)
+		adjust_count(cls, -rows)
+		return rows
+
 	async def update(self):
-		args = list(map(self.getValue, self.__fields__))
+		if self.__deferred__:
+			# never overwrite columns which were not loaded
+			fields = [f for f in self.__fields__ if f not in self.__deferred__]
+			sql = 'update `%s` set %s where `%s`=?' % (self.__table__, ', '.join(map(lambda f: '`%s`=?' % f, fields)), self.__primary_key__)
+		else:
+			fields = self.__fields__
+			sql = self.__update__
+		args = list(map(self.getValue, fields))
 		args.append(self.getValue(self.__primary_key__))
-		rows = await execute(self.__update__, args)
+		rows = await execute(sql, args)
+		invalidate(self.__class__, args[-1])
 		if rows != 1:
 			logging.warn('failed to update by primary key: affected rows: %s' % rows)
 
 	async def remove(self):
 		args = [self.getValue(self.__primary_key__)]
 		rows = await execute(self.__delete__, args)
+		invalidate(self.__class__, args[0])
+		adjust_count(self.__class__, -rows)
 		if rows != 1:
 			logging.warn('failed to remove by primary key: affected rows: %s' % rows)
 
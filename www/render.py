@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Yihang Ding'
+
+'''
+markdown rendering of blogs.
+
+Rendered HTML is cached by the hash of the content, so a popular article is
+rendered once per edit instead of once per view. Long articles are rendered
+in a process pool, so that the event loop keeps serving other requests.
+'''
+
+import os, sys, hashlib, logging, collections, asyncio
+
+from concurrent.futures import ProcessPoolExecutor
+
+import markdown2
+
+from config import configs
+
+class HtmlCache(object):
+	'''
+	LRU of rendered HTML keyed by content hash, bounded by the total size in bytes.
+	'''
+	def __init__(self, max_bytes = 32 * 1024 * 1024):
+		self.max_bytes = max_bytes
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self._entries = collections.OrderedDict()  # hash => html
+
+	def get(self, key):
+		html = self._entries.get(key)
+		if html is None:
+			self.misses += 1
+			return None
+		self._entries.move_to_end(key)
+		self.hits += 1
+		return html
+
+	def put(self, key, html):
+		size = sys.getsizeof(html)
+		if size > self.max_bytes:
+			return
+		old = self._entries.pop(key, None)
+		if old is not None:
+			self.bytes -= sys.getsizeof(old)
+		self._entries[key] = html
+		self.bytes += size
+		while self.bytes > self.max_bytes:
+			k, v = self._entries.popitem(last = False)
+			self.bytes -= sys.getsizeof(v)
+
+	def stats(self):
+		return dict(entries = len(self._entries), bytes = self.bytes, hits = self.hits, misses = self.misses)
+
+_html_cache = HtmlCache(configs.markdown.cache_bytes)
+
+markdown2.highlight_cache.max_bytes = configs.markdown.highlight_cache_bytes
+
+class ConverterPool(object):
+	'''
+	idle markdown2.Markdown instances sharing one set of options, so that a
+	conversion does not construct a Markdown. An instance is taken out of the
+	pool while it converts, convert() is not reentrant. deque.pop() and
+	append() are atomic, which makes this safe across threads.
+	'''
+	def __init__(self, max_idle = 4, **options):
+		self.options = options
+		self.max_idle = max_idle
+		self.created = 0
+		self.reused = 0
+		self._idle = collections.deque()
+
+	def convert(self, text):
+		try:
+			md = self._idle.pop()
+			self.reused += 1
+		except IndexError:
+			md = markdown2.Markdown(**self.options)
+			self.created += 1
+		try:
+			return md.convert(text)
+		finally:
+			if len(self._idle) < self.max_idle:
+				self._idle.append(md)
+
+	def stats(self):
+		return dict(idle = len(self._idle), created = self.created, reused = self.reused)
+
+_pools = {}  # options key => ConverterPool
+
+def converter_pool(**options):
+	' the shared ConverterPool of these options. '
+	key = _options_key(options)
+	pool = _pools.get(key)
+	if pool is None:
+		pool = _pools.setdefault(key, ConverterPool(**options))
+	return pool
+
+def _options_key(options):
+	' a hashable key of Markdown options, extras may be a list or a dict. '
+	L = []
+	for k, v in sorted(options.items()):
+		if isinstance(v, dict):
+			v = tuple(sorted(v.items()))
+		elif isinstance(v, list):
+			v = tuple(v)
+		L.append((k, v))
+	return tuple(L)
+
+def content_hash(content):
+	return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def text2html(text):
+	' escape plain text into paragraphs, no markdown. '
+	lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
+	return ''.join(lines)
+
+'''
+the rendering service: content shorter than offload_threshold characters is
+rendered inline, longer content in a pool of worker processes, and if that
+takes more than render_timeout seconds the escaped plain text is shown.
+markdown2 itself gives up on content over max_size or time_budget.
+'''
+
+_executor = None
+
+class RenderStats(object):
+
+	def __init__(self):
+		self.inline = 0
+		self.offloaded = 0
+		self.timeouts = 0
+		self.queued = 0  # offloaded renders not finished yet
+		self.max_queued = 0
+		self.over_budget = collections.Counter()  # stage => count
+
+_stats = RenderStats()
+
+# pid => the counters of a worker process, as returned with its last render
+_workers = {}
+
+# hashes of content which ran over the time budget inline, rendered in the
+# pool from then on so that they do not block the event loop again
+_slow = collections.OrderedDict()
+
+def start_pool(workers = None):
+	' start the worker processes, workers=None means one per CPU. '
+	global _executor
+	if workers == 0:
+		return
+	_executor = ProcessPoolExecutor(max_workers = workers)
+	logging.info('markdown rendering pool started with %s workers' % _executor._max_workers)
+
+def shutdown_pool():
+	global _executor
+	if _executor is not None:
+		_executor.shutdown(wait = False)
+		_executor = None
+		_workers.clear()
+
+_blog_converter = None
+
+def _markdown(content):
+	' runs inline or in a worker process. '
+	global _blog_converter
+	if _blog_converter is None:
+		_blog_converter = converter_pool(extras = configs.markdown.extras,
+			max_size = configs.markdown.max_size, time_budget = configs.markdown.time_budget)
+	return _blog_converter.convert(content)
+
+def _markdown_offloaded(content):
+	' runs in a worker process, returns the html with the counters of the worker. '
+	return _markdown(content), os.getpid(), _process_stats()
+
+def _process_stats():
+	return dict(converters = [dict(pool.stats(), options = pool.options) for pool in _pools.values()],
+		memoized = markdown2.memoized_stats(), highlight_cache = markdown2.highlight_cache.stats())
+
+def _count_budget(html):
+	stage = getattr(html, 'budget_exceeded', None)
+	if stage is not None:
+		_stats.over_budget[stage] += 1
+	return html
+
+def _final(html):
+	' False for the time budget fallback, which a busy machine can cause. '
+	return getattr(html, 'budget_exceeded', 'size') == 'size'
+
+def _done(future):
+	_stats.queued -= 1
+	if not future.cancelled() and future.exception() is None:
+		html, pid, stats = future.result()
+		if _executor is not None:
+			_workers[pid] = stats
+
+def _cache_late(key):
+	def callback(future):
+		if not future.cancelled() and future.exception() is None and _final(future.result()[0]):
+			_html_cache.put(key, future.result()[0])
+	return callback
+
+async def _render(content, key):
+	if _executor is None or (len(content) < configs.markdown.offload_threshold and key not in _slow):
+		_stats.inline += 1
+		html = _count_budget(_markdown(content))
+		if not _final(html):
+			_slow[key] = True
+			if len(_slow) > 1024:
+				_slow.popitem(last = False)
+		return html
+	_stats.offloaded += 1
+	_stats.queued += 1
+	_stats.max_queued = max(_stats.max_queued, _stats.queued)
+	future = asyncio.get_event_loop().run_in_executor(_executor, _markdown_offloaded, content)
+	future.add_done_callback(_done)
+	try:
+		html, pid, stats = await asyncio.wait_for(asyncio.shield(future), configs.markdown.render_timeout)
+		return _count_budget(html)
+	except asyncio.TimeoutError:
+		# the worker keeps going, cache its result for the next view
+		future.add_done_callback(_cache_late(key))
+		_stats.timeouts += 1
+		logging.warning('rendering %s characters of markdown timed out' % len(content))
+		return None
+
+async def render_markdown(content):
+	'''
+	Render markdown content to HTML through the cache. Return (html, final):
+	final is False for the plain text shown when rendering timed out or ran
+	over the time budget, which must not be stored in place of the real
+	render. Only the size fallback depends on the content alone.
+	'''
+	key = content_hash(content)
+	html = _html_cache.get(key)
+	if html is None:
+		html = await _render(content, key)
+		if html is None:
+			return text2html(content), False
+		if not _final(html):
+			return html, False
+		_html_cache.put(key, html)
+	return html, True
+
+async def markdown_to_html(content):
+	html, final = await render_markdown(content)
+	return html
+
+def html_cache_stats():
+	return _html_cache.stats()
+
+def render_stats():
+	'''
+	converters, memoized and highlight_cache are the counters of this process,
+	which renders the inline content; workers holds the same counters of every
+	worker process that rendered offloaded content, as of its last render.
+	'''
+	return dict(inline = _stats.inline, offloaded = _stats.offloaded, timeouts = _stats.timeouts,
+		queue_depth = _stats.queued, max_queue_depth = _stats.max_queued, over_budget = dict(_stats.over_budget),
+		workers = [dict(stats, pid = pid) for pid, stats in sorted(_workers.items())], **_process_stats())